@@ -60,6 +60,7 @@ module Magritte
     class Pipe < Tree::Node
       defrec :producer
       defrec :consumer
+      defdata :capacity
     end
 
     class Or < Tree::Node
@@ -1,3 +1,5 @@
+require 'fileutils'
+
 module Magritte
   class CLI
     def self.run(argv)
@@ -8,19 +10,55 @@ module Magritte
       @argv = argv
     end
 
+    # files are [source, target] pairs. the bytecode goes to the
+    # target (by default the source with a `c` appended), and the
+    # decompilation next to it with an `x` instead.
     def compile_files(files)
-      files.each do |file|
+      files.each do |(file, target)|
+        target ||= "#{file}c"
         ast = Parser.parse(Skeleton.parse(Lexer.new(file, File.read(file))))
 
         compiler = Magritte::Compiler.new(ast)
         compiler.compile
-        compiler.render_decomp(File.open("#{file}x", 'w'))
-        compiler.render(File.open("#{file}c", 'w'))
+        write_file(target.sub(/c\z/, 'x'), 'w') { |out| compiler.render_decomp(out) }
+        write_file(target, 'wb') { |out| compiler.render(out) }
       end
     end
 
+    # written under a temporary name and renamed into place, so
+    # that a vm never reads a half-written file - the cache
+    # directory can be shared between processes.
+    def write_file(path, mode, &b)
+      FileUtils.mkdir_p(File.dirname(path))
+      tmp = "#{path}.#{Process.pid}.tmp"
+      File.open(tmp, mode, &b)
+      File.rename(tmp, path)
+    ensure
+      File.unlink(tmp) if tmp && File.exist?(tmp)
+    end
+
+    # magc [-o target] file ...
+    def parse_files(argv)
+      files = []
+      target = nil
+      argv = argv.dup
+      while (arg = argv.shift)
+        if arg == '-o'
+          target = argv.shift
+        else
+          files << [arg, target]
+          target = nil
+        end
+      end
+      files
+    end
+
     def run
-      compile_files(@argv)
+      if @argv.first == '--server'
+        Server.run(*@argv.drop(1))
+      else
+        compile_files(parse_files(@argv))
+      end
     end
   end
 end
@@ -72,6 +72,7 @@ module Magritte
       @constant_table = Table.new
       @labels = {}
       @current_label = nil
+      @closure_slots = {}
     end
 
     def label_name(name)
@@ -163,50 +164,116 @@ module Magritte
       end
     end
 
-    INT_FORMAT = 'L'
+    ######## bytecode format ########
+    # A .magc file starts with a header of MAGIC, FORMAT_VERSION and
+    # OPCODE_HASH, which the vm checks before it reads anything else.
+    # Every number after that is an unsigned LEB128 varint, and every
+    # string is stored once in a pool that the constants, symbols and
+    # labels refer to by index. Instructions are stored as their index
+    # in OPCODES, followed by the argument count and the arguments.
+    #
+    # see load.py in the vm for the reading side.
+
+    MAGIC = 'MAGC'
+    FORMAT_VERSION = 2
+
+    # must list the instructions in the order of the mkinst calls in
+    # lib/magvm/inst.py - the hash below guards against the two drifting
+    # apart, since the vm computes the same hash over its own table.
+    OPCODES = %w(
+      frame return spawn jump jumpne jumplt invoke jumpfail
+      collection index collect splat typeof
+      env current-env ref ref-get ref-set dynamic-ref env-extend
+      env-collect env-pipe env-merge env-unhinge let
+      const
+      swap dup pop
+      closure last-status intrinsic
+      channel buffered-channel env-set-output env-set-input crash rest
+      noop clear size
+      compensate wait-for-close subst-invoke closure-ref
+    ).each_with_index.to_h.freeze
+
+    # 32-bit FNV-1a over the instruction names, one per line
+    OPCODE_HASH = OPCODES.keys.join("\n").bytes.inject(0x811c9dc5) do |h, byte|
+      ((h ^ byte) * 0x01000193) & 0xffffffff
+    end
+
+    def render_varint(out, n)
+      raise "cannot encode #{n.inspect} as a varint" unless n.is_a?(Integer) && n >= 0
+
+      loop do
+        byte = n & 0x7f
+        n >>= 7
+        if n.zero?
+          out << byte.chr
+          return
+        end
+        out << (byte | 0x80).chr
+      end
+    end
+
+    # zigzag encoding, so that small negative numbers stay small
+    def render_signed(out, n)
+      render_varint(out, n >= 0 ? n << 1 : ((-n) << 1) - 1)
+    end
 
-    def render_str(out, str)
-      out << [str.size].pack(INT_FORMAT)
-      out << str
+    def opcode(name)
+      OPCODES.fetch(name) { raise "unknown instruction #{name.inspect}" }
     end
 
     def render(out)
       finalize
 
-      out << [@constant_table.size].pack(INT_FORMAT)
+      strings = Table.new
+      body = String.new(encoding: Encoding::BINARY)
+
+      render_varint(body, @constant_table.size)
       @constant_table.each do |const|
         case const
         when Value::Number
-          out << '#'
-          out << [const.value].pack(INT_FORMAT)
+          body << '#'
+          render_signed(body, const.value.to_i)
         when Value::String
-          out << '"'
-          render_str(out, const.value)
+          body << '"'
+          render_varint(body, strings.cache(const.value))
         else raise "oh no, #{const.inspect}"
         end
       end
 
-      out << [@symbol_table.size].pack(INT_FORMAT)
+      render_varint(body, @symbol_table.size)
       @symbol_table.each do |sym|
-        render_str(out, sym)
+        render_varint(body, strings.cache(sym))
       end
 
       labels = @labels.values.sort_by(&:addr)
-      out << [labels.size].pack(INT_FORMAT)
+      render_varint(body, labels.size)
       labels.each do |label|
-        render_str out, label.name
-        out << [label.addr].pack(INT_FORMAT)
-        out << (label.trace ? [1] : [0]).pack(INT_FORMAT)
-        render_str(out, label.trace.repr) if label.trace
+        render_varint(body, strings.cache(label.name))
+        render_varint(body, label.addr)
+        # 0 for no trace, otherwise the string index plus one
+        render_varint(body, label.trace ? strings.cache(label.trace.repr) + 1 : 0)
       end
 
       instrs = labels.flat_map(&:instrs)
-      out << [instrs.size].pack(INT_FORMAT)
+      render_varint(body, instrs.size)
       instrs.each do |(name, *args)|
-        render_str out, name
-        out << [args.size, *args].pack("#{INT_FORMAT}*")
+        render_varint(body, opcode(name))
+        render_varint(body, args.size)
+        args.each { |arg| render_varint(body, arg) }
+      end
+
+      out << MAGIC
+      render_varint(out, FORMAT_VERSION)
+      render_varint(out, OPCODE_HASH)
+
+      render_varint(out, strings.size)
+      strings.each do |str|
+        str = str.b
+        render_varint(out, str.size)
+        out << str
       end
 
+      out << body
       out
     end
 
@@ -221,17 +288,40 @@ module Magritte
     end
 
     def visit_lex_variable(node)
-      emit 'current-env'
-      emit 'ref', sym(node.name)
+      lex_ref(node.name)
       emit 'ref-get'
     end
 
+    # Inside a lambda, a free %-variable that the lambda never
+    # binds itself can only ever be found in the closure, so we
+    # address it there by index rather than looking it up by name.
+    # The closure env binds the free variables in sorted order
+    # (see visit_lambda).
+    def lex_ref(name)
+      if (slot = @closure_slots[name])
+        emit 'closure-ref', slot
+      else
+        emit 'current-env'
+        emit 'ref', sym(name)
+      end
+    end
+
     def visit_string(node)
       emit 'const', const(Value::String.new(node.value))
     end
 
+    # the vm only has 32-bit integers, so only literals that are
+    # exactly one become Int constants. anything else (1.5, 007)
+    # stays a string, and is parsed by the vm when it's used as a
+    # number.
+    INT_LITERAL = /\A-?(0|[1-9][0-9]*)\z/
+
     def visit_number(node)
-      emit 'const', const(Value::Number.new(node.value))
+      if node.value =~ INT_LITERAL && node.value.to_i.abs < 2**31
+        emit 'const', const(Value::Number.new(node.value))
+      else
+        emit 'const', const(Value::String.new(node.value))
+      end
     end
 
     def visit_intrinsic(node)
@@ -272,7 +362,11 @@ module Magritte
 
       emit 'current-env'
       emit 'env-extend'
-      emit 'channel'
+      if node.capacity > 0
+        emit 'buffered-channel', node.capacity
+      else
+        emit 'channel'
+      end
       emit 'env-pipe', 0, 0
 
       emit 'spawn', lhs_addr
@@ -318,21 +412,32 @@ module Magritte
         emit 'crash'
       end
 
-      pattern_labels = compile_patterns(node.name, node.range, node.patterns, node.bodies, crash)
+      free = @free_vars[node].sort
+
+      outer_slots = @closure_slots
+      bound = FreeVars.bound(node)
+      @closure_slots = {}
+      free.each_with_index do |var, i|
+        @closure_slots[var] = i unless bound.include?(var)
+      end
+
+      pattern_labels = begin
+        compile_patterns(node.name, node.range, node.patterns, node.bodies, crash)
+      ensure
+        @closure_slots = outer_slots
+      end
 
       addr = label('lambda', node.range) do
         emit 'jump', pattern_labels.first
       end
 
-      free = @free_vars[node]
       emit 'env'
-      free.sort.each do |var|
+      free.each do |var|
         # env
         emit 'dup'
 
         # val
-        emit 'current-env'
-        emit 'ref', sym(var)
+        lex_ref(var)
         emit 'ref-get'
 
         emit 'let', sym(var)
@@ -353,11 +458,15 @@ module Magritte
           emit 'current-env'
           emit 'swap'
           emit 'let', sym(bind.value)
-        when AST::Variable, AST::LexVariable
+        when AST::Variable
           emit 'current-env'
           emit 'ref', sym(bind.name)
           emit 'swap'
           emit 'ref-set'
+        when AST::LexVariable
+          lex_ref(bind.name)
+          emit 'swap'
+          emit 'ref-set'
         when AST::Access
           visit(bind.source)
           visit(bind.lookup)
@@ -561,16 +670,37 @@ module Magritte
     end
 
 
+    def single_command(subst)
+      elems = subst.group.elems
+      elems.first if elems.size == 1 && elems.first.is_a?(AST::Command)
+    end
+
+    # where subst-invoke sends the commands it can't run directly
+    def subst_fallback
+      @subst_fallback ||= label('subst-invoke') do
+        emit 'invoke'
+        emit 'return'
+      end
+    end
+
     def collect(nodes)
       nodes.each do |node|
         case node
         when AST::Subst
-          addr = label('subst') { visit(node.group); emit 'return' }
-
-          emit 'current-env'
-          emit 'env-extend'
-          emit 'env-collect'
-          emit 'frame', addr
+          if (command = single_command(node))
+            # (cmd ...) - the vm can often run the command in
+            # this frame and collect its output directly
+            emit 'collection'
+            collect(command.vec)
+            emit 'subst-invoke', subst_fallback
+          else
+            addr = label('subst') { visit(node.group); emit 'return' }
+
+            emit 'current-env'
+            emit 'env-extend'
+            emit 'env-collect'
+            emit 'frame', addr
+          end
           emit 'wait-for-close'
         when AST::Splat
           emit 'collection'
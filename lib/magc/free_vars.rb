@@ -4,6 +4,29 @@ module Magritte
       Scanner.new.collect(node, Set.new)
     end
 
+    # the names a lambda binds in its own envs, i.e. not
+    # counting the ones bound by lambdas nested inside it
+    def self.bound(lambda)
+      scanner = BoundScanner.new
+      (lambda.patterns + lambda.bodies).map { |n| scanner.visit(n) }.inject(Set.new, :merge)
+    end
+
+    class BoundScanner < Tree::Collector
+      def visit_binder(node)
+        Set.new([node.name])
+      end
+
+      def visit_assignment(node)
+        out = collect_from(node)
+        node.lhs.each { |bind| out << bind.value if bind.is_a?(AST::String) }
+        out
+      end
+
+      def visit_lambda(node)
+        Set.new
+      end
+    end
+
     class BinderScanner < Tree::Collector
       def visit_binder(node)
         Set.new([node.name])
@@ -30,4 +30,5 @@ module Magritte
   load "#{LIB_DIR}/compiler.rb"
 
   load "#{LIB_DIR}/cli.rb"
+  load "#{LIB_DIR}/server.rb"
 end
@@ -169,6 +169,10 @@ module Magritte
       elsif scan /&/
         skip_ws
         return token(:amp)
+      elsif scan /\|([0-9]+)/
+        # a buffered pipe, e.g. `produce |16 consume`
+        skip_ws
+        return token(:pipe, group(1))
       elsif scan /\|/
         skip_ws
         return token(:pipe)
@@ -106,8 +106,8 @@ module Magritte
         return AST::Spawn[parse_line(body)]
       end
 
-      item.match(rsplit(~_, token(:pipe), ~_)) do |before, after|
-        return AST::Pipe[parse_line(before), parse_command(after)]
+      item.match(rsplit(~_, ~token(:pipe), ~_)) do |pipe, before, after|
+        return AST::Pipe[parse_line(before), parse_command(after), pipe.value.to_i]
       end
 
       # Match any line that has an equal sign
@@ -0,0 +1,97 @@
+require 'socket'
+require 'fileutils'
+
+module Magritte
+  # A long-lived compiler, so that the vm doesn't have to start
+  # a ruby process (and load all of lib/magc) for every stale file.
+  #
+  # The protocol is line-based: a client connects, sends the paths
+  # of the files to compile one per line, and ends its request with
+  # an empty line. A path may be followed by a tab and the path to
+  # write the bytecode to (see CLI#compile_files). The server compiles them in order and answers each
+  # with a line of either `ok` or `error: <message>`, then closes the
+  # connection. Paths are resolved against the server's working
+  # directory, so clients should send absolute ones.
+  #
+  # When the compiler's own source changes, the server re-executes
+  # itself before serving the next request rather than emit bytecode
+  # from stale code. Clients that find the connection closed without
+  # an answer fall back to spawning `magc`.
+  class Server
+    PREFIX = File.expand_path('../..', LIB_DIR)
+
+    def self.default_path
+      ENV['MAGRITTE_MAGC_SOCKET'] || "#{PREFIX}/log/magc.sock"
+    end
+
+    def self.run(path=default_path)
+      new(path).run
+    end
+
+    attr_reader :path
+    def initialize(path)
+      @path = path
+      @loaded_at = compiler_mtime
+    end
+
+    def run
+      FileUtils.mkdir_p(File.dirname(@path))
+      File.unlink(@path) if File.socket?(@path)
+      @server = UNIXServer.new(@path)
+
+      trap('INT') { shutdown }
+      trap('TERM') { shutdown }
+
+      loop do
+        client = @server.accept
+        begin
+          restart! if compiler_changed?
+          serve(client)
+        ensure
+          client.close unless client.closed?
+        end
+      end
+    end
+
+    def serve(client)
+      files = []
+      while (line = client.gets)
+        line = line.chomp
+        break if line.empty?
+        files << line.split("\t", 2)
+      end
+
+      files.each do |(file, target)|
+        client.puts(compile(file, target))
+      end
+    end
+
+    def compile(file, target=nil)
+      CLI.new([]).compile_files([[file, target]])
+      'ok'
+    rescue StandardError, ScriptError => e
+      "error: #{file}: #{e.message.gsub(/\s*\n\s*/, ' ')}"
+    end
+
+  private
+    def compiler_mtime
+      Dir["#{LIB_DIR}/*.rb"].map { |f| File.mtime(f) }.max
+    end
+
+    def compiler_changed?
+      compiler_mtime != @loaded_at
+    end
+
+    def restart!
+      @server.close
+      File.unlink(@path) if File.socket?(@path)
+      exec(RbConfig.ruby, $0, *ARGV)
+    end
+
+    def shutdown
+      @server.close
+      File.unlink(@path) if File.socket?(@path)
+      exit
+    end
+  end
+end
@@ -1,17 +1,17 @@
 from rpython.rlib.objectmodel import enforceargs
 import rpython.rtyper.lltypesystem.lltype as lltype
-from inst import inst_type_table, InstType
+from inst import inst_type_table, InstType, static_arg
 from util import as_dashed
 from value import *
-from debug import debug, open_shell
+from debug import debug, debugging, open_shell
 from const import const_table
 from intrinsic import intrinsics
 from env import Env
 from symbol import revsym # error messages only
-from status import Success, Fail
+from status import Success, Fail, success
 
 inst_actions = [None] * len(inst_type_table)
-inst_action_sig = enforceargs(None, lltype.Array(lltype.Signed))
+inst_action_sig = enforceargs(None, lltype.Signed)
 
 def inst_action(fn):
     """NOT_RPYTHON"""
@@ -29,115 +29,124 @@ def inst_action(fn):
 # These functions implement the instructions
 # of the vm, and are run by a Frame whenever
 # it encounters the corresponding instruction.
+# They are passed the offset of the instruction's
+# static arguments in the code table, which they
+# read with static_arg(base, i).
 #
 # see inst.py for descriptions of these.
 # see frame.py, specifically the .step() method
 #     to see how they're called.
 
 @inst_action
-def pop(frame, args):
+def pop(frame, base):
     frame.stack.pop()
 
 @inst_action
-def noop(frame, args):
+def noop(frame, base):
     pass
 
 @inst_action
-def swap(frame, args):
+def swap(frame, base):
     x = frame.pop()
     y = frame.pop()
     frame.push(x)
     frame.push(y)
 
 @inst_action
-def dup(frame, args):
-    debug(0, ['-- dup', frame.s()])
+def dup(frame, base):
+    if debugging(0): debug(0, ['-- dup', frame.s()])
     frame.push(frame.top())
 
 @inst_action
-def frame(frame, args):
+def frame(frame, base):
     env = frame.pop_env()
-    addr = args[0]
-    debug(0, ['-- frame', env.s()])
+    addr = static_arg(base, 0)
+    if debugging(0): debug(0, ['-- frame', env.s()])
     frame.proc.frame(env, addr)
 
 @inst_action
-def spawn(frame, args):
-    addr = args[0]
+def spawn(frame, base):
+    addr = static_arg(base, 0)
     env = frame.pop_env()
     new_proc = frame.proc.machine.spawn(env, addr)
-    debug(0, ['-- spawn', env.s(), new_proc.s()])
+    if debugging(0): debug(0, ['-- spawn', env.s(), new_proc.s()])
 
 @inst_action
-def collection(frame, args):
+def collection(frame, base):
     frame.push(Vector([]))
 
 @inst_action
-def const(frame, args):
-    frame.push(const_table.lookup(args[0]))
+def const(frame, base):
+    frame.push(const_table.lookup(static_arg(base, 0)))
 
 @inst_action
-def collect(frame, args):
+def collect(frame, base):
     value = frame.pop()
     collection = frame.top_vec()
     collection.push(value)
 
 @inst_action
-def splat(frame, args):
+def splat(frame, base):
     vec = frame.pop_vec()
     collection = frame.top_vec()
 
-    for v in vec.values:
+    for i in range(0, vec.size()):
+        v = vec.at(i)
         if isinstance(v, Vector):
-            collection.push_all(v.values)
+            for j in range(0, v.size()): collection.push(v.at(j))
         else:
             collection.push(v)
 
 @inst_action
-def index(frame, args):
-    idx = args[0]
+def index(frame, base):
+    idx = static_arg(base, 0)
     source = frame.pop_vec()
-    frame.push(source.values[idx])
+    frame.push(source.at(idx))
 
 @inst_action
-def current_env(frame, args):
+def current_env(frame, base):
     frame.push(frame.env)
 
 @inst_action
-def let(frame, args):
+def let(frame, base):
     val = frame.pop()
     env = frame.pop()
-    sym = args[0]
-    debug(0, [revsym(sym), '=', val.s()])
+    sym = static_arg(base, 0)
+    if debugging(0): debug(0, [revsym(sym), '=', val.s()])
     env.let(sym, val)
 
 @inst_action
-def env(frame, args):
+def env(frame, base):
     frame.push(Env())
 
 @inst_action
-def ref(frame, args):
+def ref(frame, base):
     env = frame.pop_env()
     try:
-        frame.push(env.lookup_ref(args[0]))
+        frame.push(env.lookup_ref(static_arg(base, 0)))
     except KeyError:
-        frame.fail(tagged('missing-key', env, String(revsym(args[0]))))
+        frame.fail(tagged('missing-key', env, String(revsym(static_arg(base, 0)))))
 
 @inst_action
-def dynamic_ref(frame, args):
-    debug(0, [frame.s()])
-    lookup = frame.pop_string()
+def closure_ref(frame, base):
+    frame.push(frame.env.closure_ref(static_arg(base, 0)))
+
+@inst_action
+def dynamic_ref(frame, base):
+    if debugging(0): debug(0, [frame.s()])
+    lookup = frame.pop()
+    if not isinstance(lookup, String): frame.fail(tagged('not-a-string', lookup))
     env = frame.pop_env()
-    debug(0, ['-- dynamic-ref lookup:', lookup, env.s()])
+    if debugging(0): debug(0, ['-- dynamic-ref lookup:', lookup.value, env.s()])
 
     try:
-        frame.push(env.lookup_ref(sym(lookup)))
+        frame.push(env.lookup_ref(lookup.as_symbol()))
     except KeyError:
-        ref = env.let(sym(lookup), placeholder)
+        ref = env.let(lookup.as_symbol(), placeholder)
         frame.push(ref)
 
 @inst_action
-def ref_get(frame, args):
+def ref_get(frame, base):
     ref = frame.pop_ref()
     val = ref.ref_get()
 
@@ -147,76 +156,110 @@ def ref_get(frame, args):
     frame.push(val)
 
 @inst_action
-def ref_set(frame, args):
+def ref_set(frame, base):
     val = frame.pop()
     ref = frame.pop_ref()
     ref.ref_set(val)
 
 @inst_action
-def jump(frame, args):
-    frame.pc = args[0]
+def jump(frame, base):
+    frame.pc = static_arg(base, 0)
 
 @inst_action
-def jumpne(frame, args):
+def jumpne(frame, base):
     lhs = frame.pop()
     rhs = frame.pop()
 
-    debug(0, ['-- jumpne', lhs.s(), rhs.s()])
+    if debugging(0): debug(0, ['-- jumpne', lhs.s(), rhs.s()])
 
-    # TODO: define equality properly!
-    if lhs.s() == rhs.s(): return
+    if lhs.eq(rhs): return
 
-    frame.pc = args[0]
+    frame.pc = static_arg(base, 0)
 
 @inst_action
-def jumplt(frame, args):
+def jumplt(frame, base):
     limit = frame.pop_number()
     val = frame.pop_number()
 
-    debug(0, ['-- jumplt', str(val), '<', str(limit)])
+    if debugging(0): debug(0, ['-- jumplt', str(val), '<', str(limit)])
 
     if val < limit:
-        frame.pc = args[0]
+        frame.pc = static_arg(base, 0)
 
 @inst_action
-def return_(frame, args):
+def return_(frame, base):
     proc = frame.proc
     proc.pop()
-    debug(0, ['-- returned', proc.s()])
+    if debugging(0): debug(0, ['-- returned', proc.s()])
 
     for (addr, is_unconditional) in frame.compensations:
-        debug(0, ['-- ret-comp', ('(run!)' if is_unconditional else '(skip)'), labels_by_addr[addr].name])
+        if debugging(0): debug(0, ['-- ret-comp', ('(run!)' if is_unconditional else '(skip)'), labels_by_addr[addr].name])
         if is_unconditional: proc.frame(frame.env, addr)
 
     if not proc.frames:
         proc.set_done()
 
 @inst_action
-def invoke(frame, args):
-    frame.proc.status = Success()
+def invoke(frame, base):
+    frame.proc.status = success
     collection = frame.pop_vec()
-    if not collection.values:
+    if collection.size() == 0:
         frame.fail_str('empty-invocation')
 
-    debug(0, ['-- invoke', collection.s()])
+    if debugging(0): debug(0, ['-- invoke', collection.s()])
 
     # tail elim is handled in proc.py
     # if frame.current_inst().id == InstType.RETURN:
     #     frame.proc.frames.pop()
 
-    invokee = collection.values.pop(0)
+    invokee = collection.shift()
     if not invokee.invokable: frame.fail(tagged('not-invokable', invokee))
 
     invokee.invokable.invoke(frame, collection)
 
+# the substitution of a single command, i.e. the (...) in
+# `[foo (add $x 1)]`. the command was evaluated in this frame,
+# and its output belongs in the collection below it. direct
+# intrinsics run right here, writing straight into the
+# collection; anything else gets a frame of its own that
+# writes to it, as a general substitution would (the frame
+# runs `invoke; return` at the given address).
+@inst_action
+def subst_invoke(frame, base):
+    frame.proc.status = success
+    command = frame.pop_vec()
+    collection = frame.top_vec()
+    if command.size() == 0: frame.fail_str('empty-invocation')
+
+    invokee = command.at(0)
+    if isinstance(invokee, String):
+        try:
+            invokee = frame.env.get(invokee.as_symbol())
+        except KeyError:
+            pass # the frame will report it
+
+    if isinstance(invokee, Intrinsic) and invokee.is_direct:
+        command.shift()
+        frame.direct_out = collection
+        try:
+            invokee.fn(frame, command)
+        finally:
+            frame.direct_out = None
+        return
+
+    env = frame.env.extend()
+    env.set_output(0, collection)
+    new_frame = frame.proc.frame(env, static_arg(base, 0))
+    new_frame.push(command)
+
 @inst_action
-def closure(frame, args):
-    addr = args[0]
+def closure(frame, base):
+    addr = static_arg(base, 0)
     env = frame.pop_env()
     frame.push(Function(env, addr))
 
 @inst_action
-def env_collect(frame, args):
+def env_collect(frame, base):
     env = frame.pop_env()
     collection = frame.pop_vec()
     env.set_output(0, collection)
@@ -224,105 +267,109 @@ def env_collect(frame, args):
     frame.push(env)
 
 @inst_action
-def wait_for_close(frame, args):
+def wait_for_close(frame, base):
     collection = frame.top_vec()
 
     if collection.writer_count == 0: return
 
     frame.proc.machine.channels.register(collection)
     collection.wait_for_close(frame.proc)
-    debug(0, ['-- wait-for-close', collection.s(), frame.proc.s()])
+    if debugging(0): debug(0, ['-- wait-for-close', collection.s(), frame.proc.s()])
 
 @inst_action
-def env_extend(frame, args):
+def env_extend(frame, base):
     env = frame.pop_env()
     frame.push(env.extend())
 
 @inst_action
-def env_unhinge(frame, args):
+def env_unhinge(frame, base):
     env = frame.pop_env()
     frame.push(env.unhinge())
 
 @inst_action
-def channel(frame, args):
+def channel(frame, base):
     frame.push(frame.proc.machine.make_channel())
 
 @inst_action
-def env_pipe(frame, args):
+def buffered_channel(frame, base):
+    frame.push(frame.proc.machine.make_channel(static_arg(base, 0)))
+
+@inst_action
+def env_pipe(frame, base):
     channel = frame.pop_channel()
     env = frame.pop_env()
     producer = env.extend()
     producer.set_output(0, channel)
     consumer = env.extend()
     consumer.set_input(0, channel)
-    debug(0, ['-- pipe %s | %s' % (producer.s(), consumer.s())])
+    if debugging(0): debug(0, ['-- pipe %s | %s' % (producer.s(), consumer.s())])
     frame.push(consumer)
     frame.push(producer)
 
 @inst_action
-def env_set_input(frame, args):
-    idx = args[0]
+def env_set_input(frame, base):
+    idx = static_arg(base, 0)
     inp = frame.pop_channel()
     env = frame.pop_env()
     env.set_input(idx, inp)
 
 @inst_action
-def env_set_output(frame, args):
-    idx = args[0]
+def env_set_output(frame, base):
+    idx = static_arg(base, 0)
     outp = frame.pop_channel()
     env = frame.pop_env()
     env.set_output(idx, outp)
 
 @inst_action
-def intrinsic(frame, args):
+def intrinsic(frame, base):
     try:
-        builtin = intrinsics.lookup(args[0])
+        builtin = intrinsics.lookup(static_arg(base, 0))
         frame.push(builtin)
     except IndexError:
-        frame.fail(tagged('unknown-intrinsic', String(revsym(args[0]))))
+        frame.fail(tagged('unknown-intrinsic', String(revsym(static_arg(base, 0)))))
 
 @inst_action
-def rest(frame, args):
-    size = args[0]
+def rest(frame, base):
+    size = static_arg(base, 0)
     source = frame.pop_vec()
-    assert size < len(source.values)
+    assert size <= source.size()
     assert size >= 0
-    frame.push(Vector(source.values[size:]))
+    frame.push(source.view(size))
 
 @inst_action
-def size(frame, args):
+def size(frame, base):
     source = frame.pop_vec()
-    frame.push(Int(len(source.values)))
+    frame.push(mkint(source.size()))
 
 @inst_action
-def typeof(frame, args):
+def typeof(frame, base):
     val = frame.pop()
     frame.push(String(val.typeof()))
 
 @inst_action
-def crash(frame, args):
+def crash(frame, base):
     reason = frame.pop()
-    debug(0, ['-- crash: ', frame.proc.s(), reason.s()])
+    if debugging(0): debug(0, ['-- crash: ', frame.proc.s(), reason.s()])
     raise Crash(reason)
 
 @inst_action
-def clear(frame, args):
+def clear(frame, base):
     if len(frame.stack) > 1:
         frame.stack.pop(len(frame.stack) - 1)
-    debug(0, ['-- clear', frame.s()])
+    if debugging(0): debug(0, ['-- clear', frame.s()])
 
 @inst_action
-def last_status(frame, args):
+def last_status(frame, base):
     frame.push(frame.proc.status)
 
 @inst_action
-def jumpfail(frame, args):
+def jumpfail(frame, base):
     status = frame.pop_status()
-    debug(0, ['-- jumpfail', status.s()])
+    if debugging(0): debug(0, ['-- jumpfail', status.s()])
     if not status.is_success():
-        frame.pc = args[0]
+        frame.pc = static_arg(base, 0)
 
 @inst_action
-def compensate(frame, args):
-    is_unconditional = (args[1] == 1)
-    frame.add_compensation(args[0], is_unconditional)
+def compensate(frame, base):
+    is_unconditional = (static_arg(base, 1) == 1)
+    frame.add_compensation(static_arg(base, 0), is_unconditional)
@@ -0,0 +1,74 @@
+from rpython.rlib.rarithmetic import r_uint, intmask
+from rpython.rlib.listsort import TimSort
+from util import read_file
+from inst import opcode_hash, FORMAT_VERSION
+import os
+
+############ bytecode cache ###############
+# Without a cache, compiled files are written next to their
+# source and judged stale by mtime. With a cache directory
+# (MAGRITTE_CACHE_DIR, or --cache-dir), they are stored in it
+# under a hash of everything that determines their content:
+# the source text, the bytecode format, the instruction table
+# and the compiler's own source. A file that is in the cache
+# is never stale, so a fresh checkout of unchanged code
+# doesn't recompile anything, read-only source trees work,
+# and identical files share one compiled copy.
+class BytecodeCache(object):
+    def __init__(self):
+        self.dir = None
+        self.compiler_id = None
+
+    def setup(self):
+        if self.dir is not None: return
+        try:
+            self.dir = os.environ['MAGRITTE_CACHE_DIR']
+        except KeyError:
+            pass
+
+    def is_enabled(self):
+        return self.dir is not None
+
+    def path_for(self, fname):
+        return '%s/%s.magc' % (self.dir, hex64(fnv1a64(self.key_prefix(), read_file(fname))))
+
+    def key_prefix(self):
+        if self.compiler_id is None:
+            self.compiler_id = '%d:%d:%s\n' % (FORMAT_VERSION, opcode_hash, hex64(compiler_hash()))
+
+        return self.compiler_id
+
+# the compiler's source files, in a fixed order
+def compiler_hash():
+    magc_dir = os.environ['MAGRITTE_PREFIX'] + '/lib/magc'
+    names = [n for n in os.listdir(magc_dir) if n.endswith('.rb')]
+    TimSort(names).sort()
+
+    h = FNV64_OFFSET
+    for name in names:
+        h = fnv1a64_update(h, name + '\n')
+        h = fnv1a64_update(h, read_file(magc_dir + '/' + name))
+
+    return h
+
+FNV64_OFFSET = r_uint(0xcbf29ce484222325)
+FNV64_PRIME = r_uint(0x100000001b3)
+
+def fnv1a64_update(h, s):
+    for c in s:
+        h = (h ^ r_uint(ord(c))) * FNV64_PRIME
+    return h
+
+def fnv1a64(prefix, s):
+    return fnv1a64_update(fnv1a64_update(FNV64_OFFSET, prefix), s)
+
+HEX_DIGITS = '0123456789abcdef'
+
+def hex64(h):
+    out = ['0'] * 16
+    for i in range(0, 16):
+        out[15 - i] = HEX_DIGITS[intmask(h & r_uint(0xf))]
+        h = h >> 4
+    return ''.join(out)
+
+bytecode_cache = BytecodeCache()
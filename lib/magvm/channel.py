@@ -1,5 +1,5 @@
 from value import *
-from debug import debug
+from debug import debug, debugging
 from status import Status
 
 class Close(Status):
@@ -22,14 +22,54 @@ class Receiver(Blocker):
         self.proc = proc
         self.into = into
         self.count = count
-
-    def receive(self, val):
-        self.count -= 1
-        debug(0, ['remaining', str(self.count), str(self.is_done())])
-        if self.is_done(): self.proc.set_running()
-
-        debug(0, ['receiving', val.s(), 'into', self.into.s()])
-        self.into.channelable.write(self.proc, val)
+        self.pending_writes = 0
+        self.is_closed = False
+        self.is_cancelled = False
+
+    # Values arrive in runs, as many as the sender has and we still
+    # want, and each run is written to the target as it arrives. If the
+    # target is a real channel that can't take a run yet, it waits there
+    # as a ForwardSender. The proc is already waiting on the read, so it
+    # doesn't wait a second time: it is woken once the read is complete
+    # and every run it passed on has been taken.
+    def receive_all(self, vals):
+        self.count -= len(vals)
+        if debugging(0): debug(0, ['remaining', str(self.count), str(self.is_done())])
+
+        if debugging(0): debug(0, ['receiving', str(len(vals)), 'into', self.into.s()])
+        into = self.into.channelable
+        if into.blocks_writer():
+            into.forward_all(self, vals)
+        else:
+            into.write_all(self.proc, vals)
+
+        self.try_wake()
+
+    # a run we passed on has been taken
+    def write_done(self):
+        self.pending_writes -= 1
+        self.try_wake()
+
+    def try_wake(self):
+        if self.pending_writes > 0: return
+        if self.is_done() or self.is_closed: self.proc.try_set_running()
+
+    # The read can't complete any more. Runs we already passed on still
+    # go through first: the close is queued, and the proc only unwinds
+    # once they have been taken (see Proc.try_set_running).
+    def interrupt(self, status):
+        if self.pending_writes == 0: return self.proc.interrupt(status)
+
+        self.is_closed = True
+        self.proc.queue_interrupt(status)
+
+    # The target closed under us, so nothing we read can go anywhere.
+    # The read is given up on, and the channel drops us from its queue.
+    def cancel(self, status):
+        if self.is_cancelled: return
+
+        self.is_cancelled = True
+        self.proc.interrupt(status)
 
     def is_done(self):
         return self.count <= 0
@@ -44,15 +84,19 @@ class Sender(Blocker):
         self.values = values
         self.index = 0
 
-    def next_val(self):
-        # [jneen] nice thought, but this array might be still in use!
-        # if we take this approach we have to be sure we copy stuff. should
-        # see if that makes a perf difference.
-        # (out, self.values[self.index]) = (self.values[self.index], None)
-        out = self.values[self.index]
+    # [jneen] the values array might be still in use, so we can't hand
+    # it out or clear it as we go - the run we send is always a copy.
+    def next_vals(self, count):
+        # a read always takes at least one value
+        if count < 1: count = 1
 
-        self.index += 1
-        return out
+        start = self.index
+        end = start + count
+        if end > len(self.values): end = len(self.values)
+        assert start >= 0 and end >= start
+
+        self.index = end
+        return self.values[start:end]
 
     def current_val(self):
         return self.values[self.index]
@@ -61,11 +105,18 @@ class Sender(Blocker):
         return self.index >= len(self.values)
 
     def send(self, receiver):
-        debug(0, ['sending', self.s()])
+        if debugging(0): debug(0, ['sending', self.s()])
+
+        receiver.receive_all(self.next_vals(receiver.count))
+        if debugging(0): debug(0, ['sender is_done()', str(self.is_done())])
+        if self.is_done(): self.wake()
 
-        receiver.receive(self.next_val())
-        debug(0, ['sender is_done()', str(self.is_done())])
-        if self.is_done(): self.proc.try_set_running()
+    # all of our values have been taken
+    def wake(self):
+        self.proc.try_set_running()
+
+    def close(self, status):
+        self.proc.interrupt(status)
 
     def s(self):
         out = ['<sender@', self.proc.s()]
@@ -76,23 +127,79 @@ class Sender(Blocker):
         out.append('>')
         return ''.join(out)
 
+# A run a Receiver passed on to its target while its read is still
+# going. It answers to the receiver rather than straight to the proc.
+class ForwardSender(Sender):
+    def __init__(self, receiver, values):
+        Sender.__init__(self, receiver.proc, values)
+        self.receiver = receiver
+
+    def wake(self):
+        self.receiver.write_done()
+
+    def close(self, status):
+        self.receiver.cancel(status)
+
+# A first-in first-out list of blocked senders or receivers. Blockers
+# are taken off the front by moving the head forward, and the list is
+# only compacted once the consumed part makes up half of it, so pushing
+# and shifting are both amortized O(1).
+class WaitQueue(object):
+    def __init__(self):
+        self.items = []
+        self.head = 0
+
+    def push(self, blocker):
+        self.items.append(blocker)
+
+    def is_empty(self):
+        return self.head >= len(self.items)
+
+    def first(self):
+        return self.items[self.head]
+
+    def shift(self):
+        self.items[self.head] = None
+        self.head += 1
+
+        if self.head * 2 >= len(self.items):
+            self.items = self.items[self.head:]
+            self.head = 0
+
+    def pending(self):
+        return self.items[self.head:]
+
+    def s(self):
+        return ' '.join([b.s() for b in self.pending()])
+
 
+# A channel with a capacity of 0 is a pure rendezvous: every write
+# waits until a reader has taken all of its values. With a capacity,
+# values are kept in a buffer, and writers only wait once it is full,
+# and readers only once it is empty.
 class Channel(Value):
     INIT = 0
     OPEN = 1
     CLOSED = 2
 
-    def __init__(self):
+    def __init__(self, capacity=0):
+        assert capacity >= 0
+        self.capacity = capacity
+        self.buffer = []
         self.writers = []
         self.readers = []
         self.reader_count = 0
         self.writer_count = 0
-        self.senders = []
-        self.receivers = []
+        self.senders = WaitQueue()
+        self.receivers = WaitQueue()
         self.state = Channel.INIT
         self.channelable = Channel.Impl(self)
 
     def s(self):
+        if self.is_buffered():
+            return '<channel%d %d/%d:%s %d/%d>' % (self.id, self.reader_count, self.writer_count, self.state_name(),
+                                                   len(self.buffer), self.capacity)
+
         return '<channel%d %d/%d:%s>' % (self.id, self.reader_count, self.writer_count, self.state_name())
 
     def typeof(self): return 'channel'
@@ -105,6 +212,79 @@ class Channel(Value):
 
     def is_closed(self): return self.state == Channel.CLOSED
     def is_open(self): return self.state != Channel.CLOSED
+    def is_buffered(self): return self.capacity > 0
+
+    # take up to `count` values off the front of the buffer
+    def unbuffer(self, count):
+        if count < 1: count = 1
+        if count > len(self.buffer): count = len(self.buffer)
+        assert count >= 0
+        out = self.buffer[:count]
+        self.buffer = self.buffer[count:]
+        return out
+
+    # fill up the buffer first, returns what doesn't fit and has to wait
+    def buffer_what_fits(self, vals):
+        if not self.is_buffered() or not self.senders.is_empty(): return vals
+
+        room = self.capacity - len(self.buffer)
+        assert room >= 0
+        if room >= len(vals):
+            if debugging(0): debug(0, ['-- write to buffer', Vector(vals).s()])
+            self.buffer.extend(vals)
+            return []
+
+        self.buffer.extend(vals[:room])
+        return vals[room:]
+
+    # receivers that gave up on their read (see Receiver.cancel) are
+    # dropped once they come up
+    def drop_cancelled(self):
+        while not self.receivers.is_empty():
+            receiver = self.receivers.first()
+            assert isinstance(receiver, Receiver)
+            if not receiver.is_cancelled: return
+            self.receivers.shift()
+
+    # each handoff moves a whole run of values, as many as
+    # the first sender has and the first receiver wants.
+    def transfer(self):
+        self.drop_cancelled()
+        while not (self.senders.is_empty() or self.receivers.is_empty()):
+            sender = self.senders.first()
+            receiver = self.receivers.first()
+            assert isinstance(sender, Sender)
+            assert isinstance(receiver, Receiver)
+            sender.send(receiver)
+
+            if sender.is_done(): self.senders.shift()
+            if receiver.is_done(): self.receivers.shift()
+            self.drop_cancelled()
+
+    # move values out of the buffer to the waiting receivers, and from
+    # the waiting senders into the free space, until neither can move.
+    def transfer_buffered(self):
+        progress = True
+        while progress:
+            progress = False
+
+            self.drop_cancelled()
+            while self.buffer and not self.receivers.is_empty():
+                receiver = self.receivers.first()
+                assert isinstance(receiver, Receiver)
+                receiver.receive_all(self.unbuffer(receiver.count))
+                if receiver.is_done(): self.receivers.shift()
+                self.drop_cancelled()
+                progress = True
+
+            while len(self.buffer) < self.capacity and not self.senders.is_empty():
+                sender = self.senders.first()
+                assert isinstance(sender, Sender)
+                self.buffer.extend(sender.next_vals(self.capacity - len(self.buffer)))
+                if sender.is_done():
+                    self.senders.shift()
+                    sender.wake()
+                progress = True
 
     def check_for_close(self):
         # set up the initial state if we've got readers or writers
@@ -114,71 +294,119 @@ class Channel(Value):
 
         if self.state != Channel.OPEN: return False
 
-        debug(0, ['check_for_close', self.s()])
+        if debugging(0): debug(0, ['check_for_close', self.s()])
         if self.reader_count > 0 and self.writer_count > 0: return False
 
-        debug(0, ['closing', self.s()])
+        # readers still get whatever was buffered before the writers left
+        if self.reader_count > 0 and self.buffer: return False
+
+        if debugging(0): debug(0, ['closing', self.s()])
         self.state = Channel.CLOSED
 
-        for blocker in self.senders:
-            blocker.proc.interrupt(Close(self, False))
+        for sender in self.senders.pending():
+            assert isinstance(sender, Sender)
+            sender.close(Close(self, False))
 
-        for blocker in self.receivers:
-            blocker.proc.interrupt(Close(self, True))
+        for receiver in self.receivers.pending():
+            assert isinstance(receiver, Receiver)
+            if not receiver.is_cancelled: receiver.interrupt(Close(self, True))
 
         return True
 
     @impl
     class Impl(Channelable):
+        def blocks_writer(self): return True
+
         def read(self, proc, count, into):
             if self.is_closed(): return proc.interrupt(Close(self, True))
-            self.receivers.append(Receiver(proc, count, into))
-            debug(0, ['-- read set-waiting', str(count)])
+            receiver = Receiver(proc, count, into)
+            proc.machine.mark_dirty(self)
+
+            # if the buffer already has everything we want, there's no
+            # need to wait for the resolve phase
+            if self.receivers.is_empty() and len(self.buffer) >= max(count, 1):
+                if debugging(0): debug(0, ['-- read from buffer', str(count)])
+                receiver.receive_all(self.unbuffer(count))
+
+                # the read is done, but what it passed on may not be
+                if receiver.pending_writes > 0: proc.set_waiting()
+                return
+
+            self.receivers.push(receiver)
+            if debugging(0): debug(0, ['-- read set-waiting', str(count)])
             proc.set_waiting()
 
+        # a single value that fits in the buffer goes straight in,
+        # anything else needs a list to wait in
+        def write(self, proc, val):
+            if (self.is_buffered() and not self.is_closed()
+                    and self.senders.is_empty()
+                    and len(self.buffer) < self.capacity):
+                proc.machine.mark_dirty(self)
+                self.buffer.append(val)
+                return
+
+            self.channelable.write_all(proc, [val])
+
         def write_all(self, proc, vals):
             if self.is_closed(): return proc.interrupt(Close(self, False))
-            self.senders.append(Sender(proc, vals))
-            debug(0, ['-- write set-waiting', Vector(vals).s()])
+            proc.machine.mark_dirty(self)
+
+            vals = self.buffer_what_fits(vals)
+            if not vals: return
+
+            self.senders.push(Sender(proc, vals))
+            if debugging(0): debug(0, ['-- write set-waiting', Vector(vals).s()])
             proc.set_waiting()
 
+        def forward_all(self, receiver, vals):
+            if self.is_closed(): return receiver.cancel(Close(self, False))
+            receiver.proc.machine.mark_dirty(self)
+
+            vals = self.buffer_what_fits(vals)
+            if not vals: return
+
+            receiver.pending_writes += 1
+            self.senders.push(ForwardSender(receiver, vals))
+            if debugging(0): debug(0, ['-- forward', Vector(vals).s()])
+
         def add_writer(self, frame):
-            debug(0, ['-- add_writer', str(self.writer_count + 1), self.s(), frame.s()])
+            if debugging(0): debug(0, ['-- add_writer', str(self.writer_count + 1), self.s(), frame.s()])
             self.writer_count += 1
+            frame.proc.machine.mark_dirty(self)
 
         def add_reader(self, frame):
-            debug(0, ['-- add_reader', str(self.reader_count + 1), self.s(), frame.s()])
+            if debugging(0): debug(0, ['-- add_reader', str(self.reader_count + 1), self.s(), frame.s()])
             self.reader_count += 1
+            frame.proc.machine.mark_dirty(self)
 
         def rm_writer(self, frame):
             if self.is_closed(): return
-            debug(0, ['-- rm_writer',
-                      str(self.writer_count - 1),
-                      self.s(), frame.s()]
-                    + [s.s() for s in self.senders]
-                    + [r.s() for r in self.receivers])
+            if debugging(0):
+                debug(0, ['-- rm_writer',
+                          str(self.writer_count - 1),
+                          self.s(), frame.s()]
+                        + [self.senders.s(), self.receivers.s()])
             self.writer_count -= 1
+            frame.proc.machine.mark_dirty(self)
 
         def rm_reader(self, frame):
             if self.is_closed(): return
-            debug(0, ['-- rm_reader',
-                      str(self.reader_count - 1),
-                      self.s(), frame.s()]
-                    + [s.s() for s in self.senders]
-                    + [r.s() for r in self.receivers])
+            if debugging(0):
+                debug(0, ['-- rm_reader',
+                          str(self.reader_count - 1),
+                          self.s(), frame.s()]
+                        + [self.senders.s(), self.receivers.s()])
             self.reader_count -= 1
+            frame.proc.machine.mark_dirty(self)
 
         def resolve(self):
             if self.is_closed(): return False
 
-            while self.senders and self.receivers:
-                (sender, receiver) = (self.senders.pop(0), self.receivers.pop(0))
-                sender.send(receiver)
-
-                if not sender.is_done(): self.senders.insert(0, sender)
-                if not receiver.is_done(): self.receivers.insert(0, receiver)
+            if self.is_buffered(): self.transfer_buffered()
+            else: self.transfer()
 
-            debug(0, ['-- still waiting:['] + [p.s() for p in self.senders + self.receivers] + [']'])
+            if debugging(0): debug(0, ['-- still waiting:[', self.senders.s(), self.receivers.s(), ']'])
 
             return self.check_for_close()
 
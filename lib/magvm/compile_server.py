@@ -0,0 +1,87 @@
+from debug import debug
+import os
+
+from rpython.rlib.rsocket import RSocket, UNIXAddress, AF_UNIX, SOCK_STREAM, SocketError
+
+############ compile server ###############
+# A client for `magc --server` (see lib/magc/server.rb),
+# which keeps the compiler loaded between compiles instead
+# of paying for a ruby process per stale file.
+#
+# Requests are the absolute paths of the files to compile,
+# each with a tab and the path to write the bytecode to, one
+# per line, ending with an empty line. The server
+# answers every file with a line of `ok` or `error: ...`.
+# If there is no server, or it goes away before answering,
+# .compile() returns False and the caller spawns magc
+# itself. A server that takes longer than TIMEOUT seconds
+# to answer counts as gone too. After the first failed
+# connection we don't try again for the rest of the run.
+TIMEOUT = 30.0
+
+class CompileServer(object):
+    def __init__(self):
+        self.is_down = False
+
+    def socket_path(self):
+        try:
+            return os.environ['MAGRITTE_MAGC_SOCKET']
+        except KeyError:
+            return os.environ['MAGRITTE_PREFIX'] + '/log/magc.sock'
+
+    def compile(self, fnames, targets):
+        if self.is_down: return False
+
+        path = self.socket_path()
+        if not os.path.exists(path):
+            self.is_down = True
+            return False
+
+        request = []
+        for (i, fname) in enumerate(fnames):
+            request.append(absolute_path(fname))
+            request.append('\t')
+            request.append(absolute_path(targets[i]))
+            request.append('\n')
+        request.append('\n')
+
+        try:
+            sock = RSocket(AF_UNIX, SOCK_STREAM)
+            sock.settimeout(TIMEOUT)
+            try:
+                sock.connect(UNIXAddress(path))
+                sock.sendall(''.join(request))
+                response = recv_all(sock)
+            finally:
+                sock.close()
+        # a timeout is a SocketError too
+        except SocketError as e:
+            debug(0, ['compile server unavailable:', e.get_msg()])
+            self.is_down = True
+            return False
+
+        lines = response.split('\n')
+        if len(lines) <= len(fnames):
+            debug(0, ['compile server hung up, falling back to magc'])
+            return False
+
+        for i in range(0, len(fnames)):
+            line = lines[i]
+            if line != 'ok': os.write(2, line + '\n')
+
+        return True
+
+def recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk: break
+        chunks.append(chunk)
+
+    return ''.join(chunks)
+
+def absolute_path(fname):
+    if fname.startswith('/'): return fname
+    return os.getcwd() + '/' + fname
+
+compile_server = CompileServer()
@@ -8,7 +8,7 @@ class Debugger(object):
         self.fname = None
 
     def should_debug(self, level):
-        return level <= self.level
+        return level <= self.level and self.fd > 0
 
     def setup(self):
         if self.fname: self.open_file()
@@ -19,7 +19,7 @@ class Debugger(object):
     def debug(self, level, parts):
         assert isinstance(level, int)
 
-        if self.should_debug(level) and self.fd > 0:
+        if self.should_debug(level):
             os.write(self.fd, ' '.join(parts) + '\n')
 
 debugger = Debugger()
@@ -41,6 +41,19 @@ try:
 except KeyError:
     debug_enabled = False
 
+# Whether a message at this level would be written. Trace points
+# that have to do any work to build their message (stringifying
+# values, envs, frames) check this first:
+#
+#     if debugging(0): debug(0, ['-- frame', env.s()])
+#
+# debug_enabled is fixed when this module is imported, so in a
+# build translated with MAGRITTE_DEBUG=off this folds to False
+# and the translator drops the trace points entirely.
+def debugging(level):
+    if not debug_enabled: return False
+    return debugger.should_debug(level)
+
 def debug(level, parts):
     if not debug_enabled: return
     debugger.debug(level, parts)
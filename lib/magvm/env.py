@@ -1,5 +1,6 @@
 from value import *
 from symbol import revsym
+from rpython.rlib.jit import elidable, promote
 
 ############ environments ###############
 # An environment in Magritte is a simple
@@ -11,24 +12,113 @@ from symbol import revsym
 #
 # An environment additionally contains
 # input and output channels, which can
-# be inherited.
+# be inherited. The channel slots are only
+# allocated once a channel is set.
+#
+# The keys of an environment are not stored
+# in the environment itself, but in a shared
+# EnvMap (a "hidden class"): envs that were
+# given the same keys in the same order share
+# one map, and keep only their refs, in the
+# order of the map's keys.
 #
 # see frame.py for how the channels are used
 # see actions.py and intrinsics.py for
 # the basic operations from the machine.
+#
+# Lookups walk the parent chain, which grows
+# with every function call (see Function in
+# value.py), so each env remembers the refs it
+# found through its parent in .memo. A memo entry
+# is stamped with the binding version of its
+# symbol, which is bumped whenever the symbol is
+# bound in an env that has children - the only
+# kind of binding that can change what a lookup
+# through a parent finds.
+#
+# A function call's env also sees the bindings of
+# the function's closure env, as if they were its
+# own (see .link()). Rather than copying them in,
+# it keeps a pointer to the closure in .closure and
+# consults it after its own refs, so a call costs
+# the same however much the function closes over.
 MAX_CHANNELS = 8
+
+class BindingVersions(object):
+    def __init__(self):
+        self.versions = [] # indexed by symbol id, grown on demand
+
+    def get(self, key):
+        if key < len(self.versions): return self.versions[key]
+        return 0
+
+    def bump(self, key):
+        while len(self.versions) <= key: self.versions.append(0)
+        self.versions[key] += 1
+
+binding_versions = BindingVersions()
+
+class EnvMap(object):
+    _immutable_fields_ = ['keys[*]', 'indices']
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.indices = {}
+        for (i, k) in enumerate(keys): self.indices[k] = i
+        self.transitions = {}
+
+    @elidable
+    def index_of(self, key):
+        return self.indices.get(key, -1)
+
+    # the map of an env that has all of our keys, plus `key`
+    @elidable
+    def with_key(self, key):
+        try:
+            return self.transitions[key]
+        except KeyError:
+            out = EnvMap(self.keys + [key])
+            self.transitions[key] = out
+            return out
+
+empty_map = EnvMap([])
+
+class MemoEntry(object):
+    def __init__(self, version, ref):
+        self.version = version
+        self.ref = ref
+
 class Env(Value):
     def __init__(self, parent=None):
         assert parent is None or isinstance(parent, Env)
         self.parent = parent
-        self.inputs = [None] * MAX_CHANNELS
-        self.outputs = [None] * MAX_CHANNELS
-        self.dict = {}
+        if parent: parent.has_children = True
+        self.has_children = False
+        self.inputs = None
+        self.outputs = None
+        self.map = empty_map
+        self.refs = []
+        self.closure = None
+        self.memo = None
+
+    def own_keys(self):
+        if self.closure is None: return self.map.keys
+
+        shown = []
+        for k in self.closure.own_keys():
+            if self.map.index_of(k) < 0: shown.append(k)
+        return self.map.keys + shown
+
+    def own_ref(self, key):
+        i = promote(self.map).index_of(key)
+        if i >= 0: return self.refs[i]
+        if self.closure is None: return None
+        return self.closure.own_ref(key)
 
     def as_dict(self):
         out = {}
-        for (k, v) in self.dict.iteritems():
-            out[revsym(k)] = v.ref_get()
+        for k in self.own_keys():
+            out[revsym(k)] = self.own_ref(k).ref_get()
 
         return out
 
@@ -53,6 +143,23 @@ class Env(Value):
     def __str__(self):
         return self.s()
 
+    # envs are equal when they bind the same keys to equal values,
+    # and are connected to the same channels.
+    def eq(self, other):
+        if self is other: return True
+        if not isinstance(other, Env): return False
+        keys = self.own_keys()
+        if len(keys) != len(other.own_keys()): return False
+        if self.get_input(0) is not other.get_input(0): return False
+        if self.get_output(0) is not other.get_output(0): return False
+
+        for k in keys:
+            ref = other.own_ref(k)
+            if ref is None: return False
+            if not self.own_ref(k).ref_get().eq(ref.ref_get()): return False
+
+        return True
+
     def extend(self):
         return Env(self)
 
@@ -62,26 +169,51 @@ class Env(Value):
     def merge(self, other):
         assert isinstance(other, Env)
 
-        # copy the *refs* here
-        for (k, v) in other.dict.iteritems():
-            self.dict[k] = v
+        # copy the *refs* here. A fresh env can take on
+        # the other's map (and closure) as a whole, which
+        # is the common case for tail calls.
+        if self.map is empty_map and self.closure is None and not self.has_children:
+            self.map = other.map
+            self.refs = other.refs[:]
+            self.closure = other.closure
+        else:
+            for k in other.own_keys():
+                self.bind(k, other.own_ref(k))
+
+        self.merge_channels(other)
+        return self
+
+    # like .merge() into a fresh env, but other's bindings
+    # are found through .closure instead of being copied.
+    # Unlike with .merge(), later bindings in other show
+    # through, which is fine for closure envs: they are
+    # complete by the time the function is created.
+    def link(self, other):
+        assert isinstance(other, Env)
+        assert self.map is empty_map and self.closure is None
 
+        self.closure = other
+        other.has_children = True
+        self.merge_channels(other)
+        return self
+
+    def merge_channels(self, other):
         # TODO: all channels
         if other.get_input(0): self.set_input(0, other.get_input(0))
         if other.get_output(0): self.set_output(0, other.get_output(0))
 
-        return self
-
     def get_input(self, i):
-        return self.inputs[i] or (self.parent and self.parent.get_input(i))
+        if self.inputs is not None and self.inputs[i]: return self.inputs[i]
+        if self.parent: return self.parent.get_input(i)
+        return None
 
     def has_input(self, ch):
-        if ch in self.inputs: return True
+        if self.inputs is not None and ch in self.inputs: return True
         if not self.parent: return False
         return self.parent.has_input(ch)
 
     def has_output(self, ch):
-        if ch in self.outputs: return True
+        if self.outputs is not None and ch in self.outputs: return True
         if not self.parent: return False
         return self.parent.has_output(ch)
 
@@ -90,16 +222,31 @@ class Env(Value):
         else: return self.has_output(channel)
 
     def get_output(self, i):
-        return self.outputs[i] or (self.parent and self.parent.get_output(i))
+        if self.outputs is not None and self.outputs[i]: return self.outputs[i]
+        if self.parent: return self.parent.get_output(i)
+        return None
+
+    # whether we see exactly the channels of base, i.e. we
+    # extend it without setting any channels along the way
+    def inherits_channels_from(self, base):
+        env = self
+        while env is not base:
+            if env is None: return False
+            if env.inputs is not None or env.outputs is not None: return False
+            env = env.parent
+
+        return True
 
     def set_input(self, i, ch):
         assert ch.channelable
-        debug(0, ['set_input', self.s(), ch.s()])
+        if debugging(0): debug(0, ['set_input', self.s(), ch.s()])
+        if self.inputs is None: self.inputs = [None] * MAX_CHANNELS
         self.inputs[i] = ch
 
     def set_output(self, i, ch):
         assert ch.channelable
-        debug(0, ['set_output', self.s(), ch.s()])
+        if debugging(0): debug(0, ['set_output', self.s(), ch.s()])
+        if self.outputs is None: self.outputs = [None] * MAX_CHANNELS
         self.outputs[i] = ch
 
     def each_input(self, fn, *a):
@@ -114,14 +261,64 @@ class Env(Value):
             if not output: return
             fn(output, *a)
 
+    def bind(self, key, ref):
+        if self.has_children: binding_versions.bump(key)
+
+        i = self.map.index_of(key)
+        if i >= 0:
+            self.refs[i] = ref
+        else:
+            self.map = self.map.with_key(key)
+            self.refs.append(ref)
+
     def lookup_ref(self, key):
-        try:
-            return self.dict[key]
-        except KeyError:
-            if self.parent:
-                return self.parent.lookup_ref(key)
-            else:
-                raise KeyError(revsym(key))
+        ref = self.own_ref(key)
+        if ref is not None: return ref
+
+        if self.parent is None: raise KeyError(revsym(key))
+
+        version = binding_versions.get(key)
+        if self.memo is None:
+            self.memo = {}
+        else:
+            entry = self.memo.get(key, None)
+            if entry is not None and entry.version == version: return entry.ref
+
+        ref = self.parent.lookup_ref(key)
+        self.memo[key] = MemoEntry(version, ref)
+        return ref
+
+    # A tail call runs in an extension of the env of the frame
+    # it replaces, which in a loop is itself an extension of
+    # the previous iteration's, and so on. Once the frame is
+    # eliminated, its env has all the bindings it will get, so
+    # we skip over the parents whose bindings it shadows - the
+    # previous iteration binding the same parameters, and the
+    # empty envs of blocks in between. This keeps the chain
+    # (and the memory of a loop) from growing with every
+    # iteration.
+    def skip_shadowed_parent(self):
+        while True:
+            parent = self.parent
+            if parent is None: return
+            if parent.inputs is not None or parent.outputs is not None: return
+            if parent.map is not empty_map and parent.map is not self.map: return
+            if parent.closure is not None and parent.closure is not self.closure: return
+
+            self.parent = parent.parent
+
+    # the compiler addresses a function's free variables by
+    # their index in its closure env (see lex_ref in
+    # lib/magc/compiler.rb). Code nested in the function runs
+    # in envs extended from the call's, so the nearest env
+    # with a closure is the call's.
+    def closure_ref(self, i):
+        env = self
+        while env.closure is None:
+            env = env.parent
+            assert env is not None
+
+        return env.closure.refs[i]
 
     def has(self, key):
         try:
@@ -132,7 +329,7 @@ class Env(Value):
 
     def let(self, key, val):
         r = Ref(val)
-        self.dict[key] = r
+        self.bind(key, r)
         return r
 
     def get(self, key):
@@ -1,11 +1,19 @@
 from env import Env
 from status import Status, Success, Fail
-from labels import labels_by_addr, inst_table
-from inst import inst_type_table, InstType
-from debug import debug
+from labels import labels_by_addr
+from inst import inst_type_table, InstType, code_table, op_at, arg_start, static_arg
+from debug import debug, debugging
 from load import arg_as_str
 from actions import inst_actions
 from value import *
+from rpython.rlib.jit import promote
+from rpython.rlib.unroll import unrolling_iterable
+
+# The actions are dispatched through an unrolled chain of
+# comparisons rather than by indexing into inst_actions, so
+# that the JIT can fold the dispatch for a constant inst_id.
+unrolling_actions = unrolling_iterable(
+    [(inst_id, action) for (inst_id, action) in enumerate(inst_actions) if action])
 
 ################# frame #####################
 # This class represents a stack frame inside
@@ -26,6 +34,8 @@ from value import *
 #     the use of many of these methods
 
 class Frame(object):
+    _immutable_fields_ = ['proc', 'addr']
+
     def crash(self, message):
         assert isinstance(message, Status)
         raise Crash(message)
@@ -37,7 +47,7 @@ class Frame(object):
         raise Crash(Fail(String(reason_str)))
 
     def add_compensation(self, addr, is_unconditional):
-        debug(0, ['-- add-compensation', self.s(), labels_by_addr[addr].name, str(is_unconditional)])
+        if debugging(0): debug(0, ['-- add-compensation', self.s(), labels_by_addr[addr].name, str(is_unconditional)])
         self.compensations.append((addr, is_unconditional))
 
     def __init__(self, proc, env, addr):
@@ -48,6 +58,8 @@ class Frame(object):
         self.pc = self.addr = addr
         self.stack = []
         self.compensations = []
+        self.direct_out = None
+        self.is_registered = False
 
     def s(self):
         out = ['<frame/']
@@ -70,18 +82,36 @@ class Frame(object):
     def __str__(self):
         return self.s()
 
-    def setup(self):
+    # A frame whose env extends the env of the frame below it,
+    # without any channels of its own in between, has exactly
+    # the channels of that frame - which stays registered for
+    # as long as this one runs. So only frames that change the
+    # channels register, and most calls skip it entirely.
+    def setup(self, below):
+        if below is not None and self.env.inherits_channels_from(below.env): return
+
+        self.is_registered = True
         self.env.each_input(register_as_input, self)
         self.env.each_output(register_as_output, self)
 
+    # when the frame we were relying on is tail eliminated, its
+    # registration passes to us instead of being dropped, so that
+    # the channels don't close in between.
+    def take_registration(self, below):
+        if self.is_registered or not below.is_registered: return
+
+        below.is_registered = False
+        self.is_registered = True
+
     def set_status(self, status):
-        debug(0, ['-- set status', status.s()])
+        if debugging(0): debug(0, ['-- set status', status.s()])
         self.proc.status = status
 
     def cleanup(self):
-        debug(0, ['-- cleanup', self.s()])
-        self.env.each_input(deregister_as_input, self)
-        self.env.each_output(deregister_as_output, self)
+        if debugging(0): debug(0, ['-- cleanup', self.s()])
+        if self.is_registered:
+            self.env.each_input(deregister_as_input, self)
+            self.env.each_output(deregister_as_output, self)
         is_success = self.proc.status.is_success()
         self.proc.last_cleaned.append(self)
 
@@ -137,41 +167,60 @@ class Frame(object):
     def top(self):
         return self.stack[len(self.stack)-1]
 
+    # while a direct intrinsic runs for a substitution, its
+    # output goes straight into the collection (see subst_invoke)
     def put(self, vals):
-        debug(0, ['-- put', self.env.get_output(0).s()] + [v.s() for v in vals])
+        if self.direct_out is not None:
+            self.direct_out.push_all(vals)
+            return
+
+        if debugging(0): debug(0, ['-- put', self.env.get_output(0).s()] + [v.s() for v in vals])
         self.env.get_output(0).channelable.write_all(self.proc, vals)
 
+    def put_one(self, val):
+        if self.direct_out is not None:
+            self.direct_out.push(val)
+            return
+
+        if debugging(0): debug(0, ['-- put', self.env.get_output(0).s(), val.s()])
+        self.env.get_output(0).channelable.write(self.proc, val)
+
     def get(self, into, n=1):
         self.env.get_input(0).channelable.read(self.proc, n, into)
 
     def label_name(self):
         return labels_by_addr[self.addr].name
 
-    # @enforceargs(None, lltype.Signed, lltype.Array(lltype.Signed))
-    def run_inst_action(self, inst_id, static_args):
+    def run_inst_action(self, pc):
+        inst_id = op_at(pc)
+        base = arg_start(pc)
         inst_type = inst_type_table.lookup(inst_id)
-        debug(0, ['+', inst_type.name] +
-                 [arg_as_str(inst_type, i, arg) for (i, arg) in enumerate(static_args)])
+        if debugging(0):
+            debug(0, ['+', inst_type.name] +
+                     [arg_as_str(inst_type, i, arg)
+                      for (i, arg) in enumerate(code_table.arguments(pc))])
 
-        action = inst_actions[inst_id]
-        if not action:
-            raise NotImplementedError('action for: '+inst_type_table.lookup(inst_id).name)
+        for (action_id, action) in unrolling_actions:
+            if action_id == inst_id:
+                action(self, base)
+                return
 
-        for arg in static_args:
-            assert isinstance(arg, int)
-
-        action(self, static_args)
+        raise NotImplementedError('action for: '+inst_type.name)
 
+    # the pc is a green variable of the jit driver (see proc.py), so
+    # promoting it here lets the JIT constant-fold the instruction
+    # lookup and everything read from the instruction.
     def step(self):
-        inst = self.current_inst()
-        self.pc += 1
-        self.run_inst_action(inst.inst_id, inst.arguments)
+        pc = promote(self.pc)
+        self.pc = pc + 1
+        self.run_inst_action(pc)
 
+    # a frame that will only jump to its return is done too, as
+    # after a call in the last branch of `||` or `&&`
     def should_eliminate(self):
-        return self.current_inst().inst_id == InstType.RETURN
-
-    def current_inst(self):
-        return inst_table.lookup(self.pc)
+        pc = self.pc
+        while op_at(pc) == InstType.JUMP: pc = static_arg(arg_start(pc), 0)
+        return op_at(pc) == InstType.RETURN
 
 def register_as_input(ch, frame): ch.channelable.add_reader(frame)
 def register_as_output(ch, frame): ch.channelable.add_writer(frame)
@@ -0,0 +1,59 @@
+from base import base_env
+from load import precompile_and_load_file
+from machine import machine
+from util import fnv1a, read_file
+from debug import debug
+import os
+
+############ prelude image ###############
+# Every run starts by loading and running the prelude,
+# which fills base_env. When translating, we do that
+# once ahead of time (see target() in targetmagritte.py),
+# so the loaded code and the populated base_env become
+# prebuilt data in the binary, and are there as soon
+# as it starts.
+#
+# The image remembers a hash of the prelude source it
+# was built from. If the prelude on disk has changed
+# since, base_env is put back the way it was before the
+# prelude ran, and the prelude is loaded from source as
+# usual. The image's code stays in the tables, but
+# nothing refers to it any more.
+class PreludeImage(object):
+    def __init__(self):
+        self.is_built = False
+        self.source_hash = 0
+        self.base_map = None
+        self.base_refs = None
+
+    # NOT RPYTHON, only called while translating
+    def build(self, fname):
+        self.source_hash = source_hash(fname)
+        self.base_map = base_env.map
+        self.base_refs = base_env.refs[:]
+
+        main = precompile_and_load_file(fname)
+        machine.spawn(base_env, main.addr)
+        machine.run()
+
+        self.is_built = True
+
+    # a missing prelude is fine, the image has everything we need
+    def is_fresh(self, fname):
+        if not self.is_built: return False
+        if not os.path.exists(fname): return True
+        return source_hash(fname) == self.source_hash
+
+    def discard(self):
+        if not self.is_built: return
+
+        debug(0, ['prelude image is stale, discarding'])
+        assert self.base_map is not None and self.base_refs is not None
+        base_env.map = self.base_map
+        base_env.refs = self.base_refs[:]
+        self.is_built = False
+
+def source_hash(fname):
+    return fnv1a(read_file(fname))
+
+prelude_image = PreludeImage()
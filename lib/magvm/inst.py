@@ -1,6 +1,8 @@
 from table import Table, TableEntry
 from symbol import revsym
 from intrinsic import intrinsics
+from rpython.rlib.jit import elidable
+from util import fnv1a
 
 class InstType(TableEntry):
     def __init__(self, name, static_types, in_types, out_types, doc):
@@ -32,20 +34,57 @@ class InstType(TableEntry):
 
         return arr
 
-class Inst(TableEntry):
-    name = None
-
-    def __init__(self, inst_id, arguments):
+############# loaded code ###############
+# All loaded instructions live in three flat arrays rather than in
+# one object per instruction: the instruction type at each address,
+# the offset of that instruction's first static argument, and the
+# static arguments of every instruction back to back. Arguments are
+# checked once as they are loaded, so the actions can read them
+# without re-validating them on every step.
+class CodeTable(object):
+    def __init__(self):
+        self.ops = []
+        self.arg_starts = []
+        self.args = []
+
+    def register(self, inst_id, arguments):
         for a in arguments:
             assert isinstance(a, int)
             assert a >= 0
 
-        self.inst_id = inst_id
-        assert isinstance(arguments, list)
-        self.arguments = arguments
+        addr = len(self.ops)
+        self.ops.append(inst_id)
+        self.arg_starts.append(len(self.args))
+        self.args.extend(arguments)
+        return addr
+
+    def __len__(self):
+        return len(self.ops)
+
+    # a copy of the arguments, for the decompiler and debug output
+    def arguments(self, addr):
+        start = self.arg_starts[addr]
+        if addr + 1 < len(self.ops): end = self.arg_starts[addr + 1]
+        else: end = len(self.args)
+        assert start >= 0
+        assert end >= start
+        return self.args[start:end]
+
+code_table = CodeTable()
+
+# code is only ever appended, so what is stored at a given
+# address never changes once it has been loaded.
+@elidable
+def op_at(addr):
+    return code_table.ops[addr]
+
+@elidable
+def arg_start(addr):
+    return code_table.arg_starts[addr]
 
-    def type(self):
-        return inst_type_table.lookup(self.inst_id)
+@elidable
+def static_arg(base, i):
+    return code_table.args[base + i]
 
 inst_type_table = Table()
 def mkinst(name, *a):
@@ -113,6 +152,7 @@ mkinst('intrinsic', ['intrinsic'], [], ['intrinsic'], 'load an intrinsic fn')
 
 # channels
 mkinst('channel', [], [], ['channel'], 'make a new channel')
+mkinst('buffered-channel', [None], [], ['channel'], 'make a new channel with a buffer of the given capacity')
 mkinst('env-set-output', [None], ['env', 'channel'], [], 'set the output on an env')
 mkinst('env-set-input', [None], ['env', 'channel'], [], 'set the input on an env')
 mkinst('crash', [], ['string'], [], 'crash')
@@ -124,3 +164,15 @@ mkinst('size', [], ['vector'], ['int'], 'get the size of a vector or collection'
 
 mkinst('compensate', ['inst', None], [], [], 'register a compensation')
 mkinst('wait-for-close', [], ['vector'], ['vector'], 'wait for the writers of a vector to exit')
+mkinst('subst-invoke', ['inst'], ['collection', 'collection'], ['collection'], 'invoke a command, collecting its output into the collection below it')
+mkinst('closure-ref', [None], [], ['ref'], 'load a ref from the closure of the running function, by index')
+
+############# bytecode format ###############
+# Compiled files refer to instructions by their index in this table,
+# so they carry a hash of the instruction names (in order) that the
+# loader checks against this one. Must match OPCODE_HASH in
+# lib/magc/compiler.rb, which is the same 32-bit FNV-1a.
+MAGIC = 'MAGC'
+FORMAT_VERSION = 2
+
+opcode_hash = fnv1a('\n'.join([t.name for t in inst_type_table.table]))
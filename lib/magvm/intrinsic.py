@@ -2,8 +2,8 @@ from util import as_dashed
 from table import Table, TableEntry
 from value import *
 from symbol import sym
-from debug import debug, set_debug, open_debug_file, open_shell
-from status import Success, Fail
+from debug import debug, debugging, set_debug, open_debug_file, open_shell
+from status import Success, Fail, success
 from env import Env
 from symbol import revsym
 
@@ -13,11 +13,19 @@ import os
 
 intrinsics = Table()
 
+# shared reasons for the failures that are part of normal control
+# flow (`eq $n 0 || ...`), so they don't allocate every time
+not_eq = Fail(String('not-eq'))
+no_key = Fail(String('no-key'))
+
 ################## instruction implementations #############
+# intrinsics get their arguments as the Vector they were
+# invoked with, read in place through .size() and .at(), so
+# that passing them costs nothing however many there are.
 def intrinsic(fn):
     intrinsic_name = as_dashed(fn.__name__)
     def wrapper(frame, args):
-        debug(0, [':', '@!'+intrinsic.name] + [a.s() for a in args])
+        if debugging(0): debug(0, [':', '@!'+intrinsic.name, args.s()])
         return fn(frame, args)
 
     # make sure the name is stored as a symbol
@@ -27,21 +35,37 @@ def intrinsic(fn):
     intrinsics.register(intrinsic)
     return intrinsic
 
+# marks an intrinsic that only ever puts its results and sets
+# the status. a substitution of one of these can run it right
+# in the calling frame and collect its output directly, see
+# subst_invoke in actions.py.
+def direct(intrinsic):
+    intrinsic.is_direct = True
+    return intrinsic
+
+# for intrinsics the prelude binds directly rather than through
+# a function with a pattern: crash just as that function would
+# when called with the wrong number of arguments
+def check_arity(frame, name, args, count):
+    if args.size() != count: raise Crash(tagged('pattern', String(name), args))
+
+@direct
 @intrinsic
 def add(frame, args):
     total = 0
-    for arg in args:
-        total += arg.as_number(frame)
+    for i in range(0, args.size()):
+        total += args.at(i).as_number(frame)
 
-    frame.put([Int(total)])
+    frame.put_one(mkint(total))
 
+@direct
 @intrinsic
 def mul(frame, args):
     product = 1
-    for arg in args:
-        product *= arg.as_number(frame)
+    for i in range(0, args.size()):
+        product *= args.at(i).as_number(frame)
 
-    frame.put([Int(product)])
+    frame.put_one(mkint(product))
 
 @intrinsic
 def get(frame, args):
@@ -52,15 +76,16 @@ def get(frame, args):
 
 @intrinsic
 def take(frame, args):
-    assert isinstance(args[0], Value)
-    count = args[0].as_number(frame)
+    count = args.at(0).as_number(frame)
     frame.env.get_input(0).channelable.read(frame.proc, count, frame.env.get_output(0))
 
+@direct
 @intrinsic
 def for_(frame, args):
-    for vec in args:
+    for i in range(0, args.size()):
+        vec = args.at(i)
         if not isinstance(vec, Vector): frame.fail(tagged('not-a-vector', vec))
-        frame.put(vec.values)
+        frame.put(vec.elems())
 
 @intrinsic
 def stdout(frame, args):
@@ -73,54 +98,66 @@ def stdout(frame, args):
 
 @intrinsic
 def fail(frame, args):
-    frame.set_status(Fail(args[0]))
+    frame.set_status(Fail(args.at(0)))
     frame.proc.pop()
 
 @intrinsic
 def crash(frame, args):
-    frame.crash(Fail(args[0]))
+    frame.crash(Fail(args.at(0)))
 
+@direct
 @intrinsic
 def make_channel(frame, args):
-    frame.put([frame.proc.machine.make_channel()])
+    capacity = 0
+    if args.size() > 0: capacity = args.at(0).as_number(frame)
+    if capacity < 0: frame.fail(tagged('negative-capacity', args.at(0)))
+
+    frame.put_one(frame.proc.machine.make_channel(capacity))
 
+@direct
 @intrinsic
 def str_(frame, args):
     out = ''
-    for arg in args:
-        out += arg.s()
+    for i in range(0, args.size()):
+        out += args.at(i).s()
 
-    frame.put([String(out)])
+    frame.put_one(String(out))
 
+@direct
 @intrinsic
 def eq(frame, args):
-    if args[0].eq(args[1]):
-        frame.set_status(Success())
+    check_arity(frame, 'eq', args, 2)
+    if args.at(0).eq(args.at(1)):
+        frame.set_status(success)
     else:
-        frame.set_status(Fail(String('not-eq')))
+        frame.set_status(not_eq)
 
+@direct
 @intrinsic
 def len_(frame, args):
-    vec = args[0]
+    check_arity(frame, 'len', args, 1)
+    vec = args.at(0)
     if isinstance(vec, Vector):
-        frame.put([Int(len(vec.values))])
+        frame.put_one(mkint(vec.size()))
     else:
         frame.fail(tagged('not-a-vector', vec))
         return
 
+@direct
 @intrinsic
 def getenv(frame, args):
-    key = args[0]
+    check_arity(frame, 'getenv', args, 1)
+    key = args.at(0)
     assert isinstance(key, String)
     try:
-        frame.put([String(os.environ[key.value])])
-        frame.set_status(Success())
+        frame.put_one(String(os.environ[key.value]))
+        frame.set_status(success)
     except KeyError:
-        frame.set_status(Fail(String('no-key')))
+        frame.set_status(no_key)
 
 @intrinsic
 def vm_debug(frame, args):
-    level = args[0].as_number(frame)
+    level = args.at(0).as_number(frame)
 
     debug(0, ['-- setting debug: ', str(level)])
     set_debug(level)
@@ -128,19 +165,20 @@ def vm_debug(frame, args):
 
 @intrinsic
 def vm_debug_open(frame, args):
-    fname = args[0].s()
+    fname = args.at(0).s()
     open_debug_file(fname)
 
+@direct
 @intrinsic
 def has(frame, args):
-    key = args[0].s()
-    env = args[1]
+    key = args.at(0).s()
+    env = args.at(1)
     assert isinstance(env, Env)
     boolify(env.has(sym(key)), frame, 'no-key-'+key)
 
 def boolify(b, frame, msg):
     if b:
-        frame.set_status(Success())
+        frame.set_status(success)
     else:
         frame.set_status(Fail(String(msg)))
 
@@ -149,5 +187,5 @@ def vm_debugger(frame, args):
     open_shell(frame, args)
 
 def own_keys(e):
-    return map(revsym, e.dict.keys())
+    return map(revsym, e.own_keys())
 
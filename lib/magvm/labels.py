@@ -9,7 +9,3 @@ def register_label(label):
 
 def label_by_addr(addr):
     return labels_by_addr[addr].name
-
-inst_table = Table()
-
-register_inst = inst_table.register
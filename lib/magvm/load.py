@@ -1,14 +1,16 @@
 from table import Table, Label
-from inst import inst_type_table, Inst
+from inst import inst_type_table, code_table, opcode_hash, MAGIC, FORMAT_VERSION
 from value import *
-from util import map_int
+from util import map_int, read_all
 from debug import debug
 from const import const_table
-from labels import inst_table, label_table, register_label
+from labels import label_table, register_label
 from symbol import symbol_table, sym, revsym
 from intrinsic import intrinsic, intrinsics
 from base import base_env
 from spawn import spawn
+from compile_server import compile_server
+from cache import bytecode_cache
 from status import Fail
 
 import os
@@ -22,62 +24,169 @@ def prefixed(p):
 def unescape(s):
     return s.replace('\\n', '\n').replace('\\\\', '\\')
 
-def read_int(fd):
-    out = runpack('i', os.read(fd, 4))
-    return out
+# raised for files that are not in the format this vm reads, i.e.
+# that were compiled by a different version of magc
+class BadBytecode(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+class Reader(object):
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def read_bytes(self, length):
+        start = self.pos
+        end = start + length
+        assert start >= 0 and end >= start
+        if end > len(self.buf): raise BadBytecode('truncated file')
+        self.pos = end
+        return self.buf[start:end]
+
+    def read_byte(self):
+        if self.pos >= len(self.buf): raise BadBytecode('truncated file')
+        out = ord(self.buf[self.pos])
+        self.pos += 1
+        return out
+
+    # unsigned LEB128
+    def read_varint(self):
+        out = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            out |= (byte & 0x7f) << shift
+            if byte < 0x80: return out
+            shift += 7
+
+    # zigzag-encoded, see render_signed in the compiler
+    def read_signed(self):
+        n = self.read_varint()
+        return (n >> 1) ^ -(n & 1)
+
+    def read_str(self):
+        length = self.read_varint()
+        return self.read_bytes(length)
+
+    def read_header(self):
+        if self.pos + len(MAGIC) > len(self.buf) or self.read_bytes(len(MAGIC)) != MAGIC:
+            raise BadBytecode('not a compiled magritte file')
+
+        version = self.read_varint()
+        if version != FORMAT_VERSION:
+            raise BadBytecode('unsupported format version %d' % version)
+
+        if self.read_varint() != opcode_hash:
+            raise BadBytecode('compiled for a different instruction set')
 
-def read_str(fd):
-    length = read_int(fd)
-    return os.read(fd, length)
+def load_fd(fd):
+    load_buf(read_all(fd))
 
-def read_constant(fd):
-    typechar = os.read(fd, 1)
-    if typechar == '"': return String(read_str(fd))
-    if typechar == '#': return Int(read_int(fd))
-    assert False, 'unexpected typechar %s' % typechar
+def load_buf(buf):
+    reader = Reader(buf)
+    reader.read_header()
 
-def load_fd(fd):
+    # The whole file is decoded and checked before anything is
+    # registered, so that a bad file leaves the tables as they
+    # were, and can be compiled again and reloaded (see load_file).
     offsets = {
         'const': len(const_table),
         'label': len(label_table),
-        'inst': len(inst_table),
+        'inst': len(code_table),
     }
 
+    # string pool, shared by the blocks below
+    num_strings = reader.read_varint()
+    strings = [''] * num_strings
+    for i in range(0, num_strings):
+        strings[i] = reader.read_str()
+
     # constants block
-    num_constants = read_int(fd)
+    num_constants = reader.read_varint()
+    constants = []
     for _ in range(0, num_constants):
-        const = read_constant(fd)
-        const_table.register(const)
+        typechar = reader.read_byte()
+        if typechar == ord('"'):
+            constants.append(String(pooled(strings, reader.read_varint())))
+        elif typechar == ord('#'):
+            constants.append(Int(reader.read_signed()))
+        else:
+            raise BadBytecode('unexpected typechar %d' % typechar)
 
     # symbols block
-    num_symbols = read_int(fd)
-    symbol_translation = [0] * num_symbols
+    num_symbols = reader.read_varint()
+    symbol_names = [''] * num_symbols
     for i in range(0, num_symbols):
-        val = read_str(fd)
-        symbol_translation[i] = sym(val)
+        symbol_names[i] = pooled(strings, reader.read_varint())
 
-    num_labels = read_int(fd)
+    num_labels = reader.read_varint()
+    labels = []
     for _ in range(0, num_labels):
-        name = read_str(fd)
-        addr = read_int(fd) + offsets['inst']
+        name = pooled(strings, reader.read_varint())
+        addr = reader.read_varint() + offsets['inst']
+        trace_index = reader.read_varint()
         trace = None
-        has_trace = read_int(fd)
-        trace = None
-        if has_trace == 1: trace = read_str(fd)
-        label = Label(name, addr, trace)
-        register_label(label)
+        if trace_index > 0: trace = pooled(strings, trace_index - 1)
+        labels.append(Label(name, addr, trace))
 
-    num_insts = read_int(fd)
+    num_insts = reader.read_varint()
+    num_inst_types = len(inst_type_table)
+    ops = [0] * num_insts
+    inst_args = []
     for i in range(0, num_insts):
-        command = read_str(fd)
-        num_args = read_int(fd)
+        op = reader.read_varint()
+        if op >= num_inst_types: raise BadBytecode('unknown opcode %d' % op)
+        inst_type = inst_type_table.lookup(op)
+
+        num_args = reader.read_varint()
+        if num_args != len(inst_type.static_types):
+            raise BadBytecode('wrong number of arguments to %s' % inst_type.name)
+
         raw_args = [999] * num_args
-        for i in range(0, num_args): raw_args[i] = read_int(fd)
-        inst_type = inst_type_table.get(command)
-        args = inst_type.reindex(raw_args, offsets, symbol_translation)
-        inst_table.register(Inst(inst_type.id, args))
+        for j in range(0, num_args):
+            raw_args[j] = reader.read_varint()
+            check_arg(inst_type.static_types[j], raw_args[j],
+                      num_constants, num_insts, symbol_names)
 
-def load_file(fname):
+        ops[i] = op
+        inst_args.append(raw_args)
+
+    # nothing can fail from here on
+    for constant in constants:
+        const_table.register(constant)
+
+    symbol_translation = [0] * num_symbols
+    for i in range(0, num_symbols):
+        symbol_translation[i] = sym(symbol_names[i])
+
+    for label in labels:
+        register_label(label)
+
+    for i in range(0, num_insts):
+        inst_type = inst_type_table.lookup(ops[i])
+        args = inst_type.reindex(inst_args[i], offsets, symbol_translation)
+        code_table.register(inst_type.id, args)
+
+def pooled(strings, index):
+    if index >= len(strings): raise BadBytecode('no string %d in the pool' % index)
+    return strings[index]
+
+# arguments that refer into the file's own tables have to be in
+# range, see InstType.reindex
+def check_arg(arg_type, arg, num_constants, num_insts, symbol_names):
+    if arg_type == 'const' and arg >= num_constants:
+        raise BadBytecode('no constant %d' % arg)
+    if arg_type == 'inst' and arg >= num_insts:
+        raise BadBytecode('no instruction %d' % arg)
+    if arg_type == 'sym' or arg_type == 'intrinsic':
+        if arg >= len(symbol_names): raise BadBytecode('no symbol %d' % arg)
+    if arg_type == 'intrinsic':
+        try:
+            intrinsics.get(symbol_names[arg])
+        except KeyError:
+            raise BadBytecode('unknown intrinsic %s' % symbol_names[arg])
+
+def load_compiled(fname):
     fd = 0
 
     try:
@@ -90,9 +199,40 @@ def load_file(fname):
     debug(0, ['load!', fname, str(label.addr)])
     return label
 
+def load_file(fname):
+    try:
+        return load_compiled(fname)
+    except BadBytecode as e:
+        # most likely left behind by an older magc, or cut short.
+        # the file is checked before anything is registered, so if
+        # the source is around we can compile it again and retry.
+        source = source_of(fname)
+        if source is None: raise
+
+        debug(0, ['bad bytecode, recompiling', fname, e.msg])
+        compile_file(source, fname)
+        return load_compiled(fname)
+
+def source_of(fnamec):
+    if not fnamec.endswith('.magc'): return None
+    end = len(fnamec) - 1
+    assert end >= 0
+    source = fnamec[:end]
+    if not os.path.exists(source): return None
+    return source
+
 def precompile_and_load_file(fname):
-    precompile(fname)
-    return load_file(fname + 'c')
+    return load_precompiled(fname, precompile(fname))
+
+# loads a target that precompile() or precompile_all() left
+# up to date
+def load_precompiled(fname, target):
+    try:
+        return load_compiled(target)
+    except BadBytecode as e:
+        debug(0, ['bad bytecode, recompiling', target, e.msg])
+        compile_file(fname, target)
+        return load_compiled(target)
 
 def decomp_to_file(fname):
     fd = 0
@@ -137,7 +277,7 @@ def decomp_fd(fd):
         out.append('%d %s\n' % (i, l.s()))
 
     out.append('==== instructions ====\n')
-    for (i, inst) in enumerate(inst_table.table):
+    for i in range(0, len(code_table)):
         try:
             label = labels_by_addr[i]
             out.append("%s:" % label.name)
@@ -147,33 +287,102 @@ def decomp_fd(fd):
         except KeyError:
             pass
 
-        inst_type = inst.type()
+        inst_type = inst_type_table.lookup(code_table.ops[i])
         typename = inst_type.name
         out.append('  %d %s' % (i, typename))
 
-        for (i, arg) in enumerate(inst.arguments):
-            out.append(' %s' % arg_as_str(inst_type, i, arg))
+        for (j, arg) in enumerate(code_table.arguments(i)):
+            out.append(' %s' % arg_as_str(inst_type, j, arg))
 
         out.append('\n')
 
     os.write(fd, ''.join(out))
 
 def _get_fname(args):
-    assert len(args) == 1
-    fname_obj = args[0]
+    assert args.size() == 1
+    fname_obj = args.at(0)
     assert isinstance(fname_obj, String)
     fname = fname_obj.value
     assert fname is not None
     return fname
 
-def precompile(fname):
-    fnamec = fname + 'c'
-    if os.path.exists(fnamec) and os.path.getmtime(fnamec) >= os.path.getmtime(fname): return
+# where the compiled code for a source file lives, see cache.py
+def compiled_path(fname):
+    if bytecode_cache.is_enabled(): return bytecode_cache.path_for(fname)
+    return fname + 'c'
 
-    mag_binary = prefixed('/bin/magc')
+def is_stale(fname, target):
+    if not os.path.exists(target): return True
 
-    debug(0, ['magc out of date, recompiling', mag_binary, fname])
-    spawn(mag_binary, [fname])
+    # cached files are named after their content
+    if bytecode_cache.is_enabled(): return False
+
+    return os.path.getmtime(target) < os.path.getmtime(fname)
+
+# returns the path of the up-to-date compiled file
+def precompile(fname):
+    precompile_all([fname])
+    return compiled_path(fname)
+
+# compiles whichever of the files are stale in a single
+# request, so a compile server sees them as one batch
+def precompile_all(fnames):
+    stale = []
+    targets = []
+    for fname in fnames:
+        target = compiled_path(fname)
+        if not is_stale(fname, target): continue
+
+        debug(0, ['magc out of date, recompiling', fname, target])
+        stale.append(fname)
+        targets.append(target)
+
+    if stale: compile_files(stale, targets)
+
+def compile_file(fname, target):
+    compile_files([fname], [target])
+
+# prefer a running compile server, see compile_server.py
+def compile_files(fnames, targets):
+    if compile_server.compile(fnames, targets): return
+
+    args = []
+    for (i, fname) in enumerate(fnames):
+        args.append('-o')
+        args.append(targets[i])
+        args.append(fname)
+
+    spawn(prefixed('/bin/magc'), args)
+
+# Files loaded by the `load` intrinsic, keyed by the identity of
+# the source file (its device and inode, so every path to it
+# agrees). Loading a file again only re-runs its main label,
+# unless it has changed since - its new code is then loaded as
+# usual, next to the old code.
+class Module(object):
+    def __init__(self, mtime, size, label):
+        self.mtime = mtime
+        self.size = size
+        self.label = label
+
+class ModuleRegistry(object):
+    def __init__(self):
+        self.modules = {}
+
+    def load(self, fname):
+        st = os.stat(fname)
+        key = '%d:%d' % (st.st_dev, st.st_ino)
+
+        module = self.modules.get(key, None)
+        if module is not None and module.mtime == st.st_mtime and module.size == st.st_size:
+            debug(0, ['already loaded', fname, str(module.label.addr)])
+            return module.label
+
+        label = precompile_and_load_file(fname)
+        self.modules[key] = Module(st.st_mtime, st.st_size, label)
+        return label
+
+module_registry = ModuleRegistry()
 
 @intrinsic
 def load(frame, args):
@@ -184,7 +393,7 @@ def load(frame, args):
     if not os.path.exists(fname):
         frame.fail(tagged('no-such-file', String(fname)))
 
-    label = precompile_and_load_file(fname)
+    label = module_registry.load(fname)
 
     frame.proc.frame(base_env, label.addr, tail_elim=False)
 
@@ -192,7 +401,7 @@ base_env.let(sym('load'), load)
 
 @intrinsic
 def decomp(frame, args):
-    if len(args) == 0:
+    if args.size() == 0:
         decomp_fd(1) # stdout
     else:
         fname = _get_fname(args)
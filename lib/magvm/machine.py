@@ -2,33 +2,49 @@ import sys # NOT RPYTHON
 import os
 from rpython.rlib.objectmodel import enforceargs
 import rpython.rtyper.lltypesystem.lltype as lltype
-from table import Table
+from table import Registry
 from util import as_dashed, map_int
 from value import *
 from proc import Proc, Frame
-from debug import debug
+from debug import debug, debugging
 from channel import *
 from base import base_env
 from symbol import symbol_table
 from labels import label_table
-from rpython.rlib.jit import JitDriver, elidable
 from rpython.rlib.listsort import make_timsort_class
 
-from random import shuffle
-
-jit_driver = JitDriver(greens=['pc'], reds=['env', 'stack'])
-
 ################## machine ####################
 # This class contains the main loop of the vm,
 # and implements basic scheduling among a
 # collection of Proc objects.
+#
+# Only runnable procs are kept in the run queue.
+# A proc enters the queue whenever it changes to
+# a runnable state (see Proc.transition), and is
+# dropped from it at the start of the next tick
+# once it is waiting or finished. This way the
+# cost of a tick depends only on the number of
+# runnable procs, not on how many were spawned.
+#
+# Similarly, channels (and collections that are
+# waited on) mark themselves dirty whenever their
+# state changes, and only the dirty ones are
+# visited in the resolve phase.
+#
+# The machine only hands out ids to procs and
+# channels and keeps no table of them, so
+# finished procs and channels nobody refers to
+# any more can be collected.
 class Machine(object):
     def __init__(self):
-        self.procs = Table()
-        self.channels = Table()
+        self.procs = Registry()
+        self.channels = Registry()
+        self.run_queue = []
+        self.waiting_count = 0
+        self.dirty_channels = []
 
-    def make_channel(self):
-        return self.channels.register(Channel())
+    def make_channel(self, capacity=0):
+        return self.channels.register(Channel(capacity))
 
     def spawn_label(self, env, label):
         return self.spawn(env, label_table.get(label).addr)
@@ -36,9 +52,53 @@ class Machine(object):
     def spawn(self, env, addr):
         proc = Proc(self)
         self.procs.register(proc)
+        self.schedule(proc)
         proc.frame(env, addr)
         return proc
 
+    def schedule(self, proc):
+        if proc.is_scheduled: return
+        proc.is_scheduled = True
+        self.run_queue.append(proc)
+
+    # drop the procs that are no longer runnable from the
+    # queue, and return the rest ordered by age, so that
+    # procs which have had the fewest turns go first.
+    def ready_procs(self):
+        runnable = []
+        for proc in self.run_queue:
+            if proc.is_running():
+                runnable.append(proc)
+            else:
+                proc.is_scheduled = False
+
+        self.run_queue = runnable
+
+        sort = age_sort(runnable[:])
+        sort.sort()
+        return sort.list
+
+    def mark_dirty(self, channel):
+        if channel.is_dirty: return
+        channel.is_dirty = True
+        self.dirty_channels.append(channel)
+
+    # channels marked dirty while resolving are left for
+    # the next tick.
+    def dirty_channels_by_id(self):
+        dirty = self.dirty_channels
+        self.dirty_channels = []
+
+        sort = id_sort(dirty)
+        sort.sort()
+        return sort.list
+
+    def has_runnable(self):
+        for proc in self.run_queue:
+            if proc.is_running(): return True
+
+        return False
+
     def run(self):
         debug(0, ['run!'])
         try:
@@ -50,44 +110,36 @@ class Machine(object):
 
     def step(self):
         debug(0, ['%%%%% PHASE: step %%%%%'])
-        sort = age_sort([p for p in self.procs.table])
-        sort.sort()
-        for proc in sort.list:
-            if not proc: continue
-            if proc.state == Proc.DONE: continue
-
-            debug(0, ['-- running proc', proc.s()])
+        for proc in self.ready_procs():
+            if debugging(0): debug(0, ['-- running proc', proc.s()])
             if proc.is_running():
                 proc.age += 1
-
-                jit_driver.jit_merge_point(
-                    pc=proc.current_frame().pc,
-                    stack=proc.frames,
-                    env=proc.current_frame().env
-                )
-
                 proc.step()
 
         debug(0, ['%%%%% PHASE: resolve %%%%%'])
-        for channel in self.channels.table:
-            debug(0, ['+', channel.s()])
+        for channel in self.dirty_channels_by_id():
+            if debugging(0): debug(0, ['+', channel.s()])
             assert channel.channelable is not None
+            channel.is_dirty = False
             channel.channelable.resolve()
 
         debug(0, ['%%%%% PHASE: check %%%%%'])
-        for p in self.procs.table: debug(0, [p.s()])
-
-        running = 0
-        waiting = 0
-        for proc in self.procs.table:
-            if proc.is_running():
-                running += 1
-            elif proc.state == Proc.WAITING:
-                waiting += 1
+        if debugging(0):
+            for p in self.run_queue: debug(0, [p.s()])
 
-        if running == 0 and waiting > 0: raise Deadlock
-        if running == 0: raise Done
+        if self.has_runnable() or self.dirty_channels: return
+        if self.waiting_count > 0: raise Deadlock
+        raise Done
 
 machine = Machine()
 
-age_sort = make_timsort_class(lt=lambda p, q: p.age < q.age)
+# ties are broken by spawn order, like the stable sort over
+# the whole proc table used to do
+def age_lt(p, q):
+    if p.age == q.age: return p.id < q.id
+    return p.age < q.age
+
+age_sort = make_timsort_class(lt=age_lt)
+
+# channels are resolved in the order they were created
+id_sort = make_timsort_class(lt=lambda c, d: c.id < d.id)
@@ -1,12 +1,26 @@
 from table import TableEntry
-from inst import inst_type_table, InstType
+from inst import inst_type_table, InstType, op_at
 from channel import Channel, Close
-from labels import labels_by_addr, inst_table
-from status import Status, Success, Fail
+from labels import labels_by_addr
+from status import Status, Success, Fail, success
 from util import print_list_s
 from frame import Frame
-from debug import debug, open_shell
+from debug import debug, debugging, open_shell
 from value import *
+from rpython.rlib.jit import JitDriver
+
+# Called from inside the JIT, so it must not do any I/O
+# (Table.lookup prints on a bad index).
+def get_location(pc):
+    inst_type = inst_type_table.table[op_at(pc)]
+    assert isinstance(inst_type, InstType)
+    return '%d %s' % (pc, inst_type.name)
+
+# The pc is an index into the global instruction table, so it
+# identifies a position in the program regardless of which
+# frame or proc is running it.
+jit_driver = JitDriver(greens=['pc'], reds=['frame', 'proc'],
+                       get_printable_location=get_location)
 
 ############# processes #######################
 # This class represents one process, running
@@ -23,42 +37,58 @@ class Proc(TableEntry):
     TERMINATED = 5  # there has been a crash, probably due to an error
 
     def set_init(self):
-        debug(0, ['-- set-init', self.s()])
-        self.state = Proc.INIT
+        if debugging(0): debug(0, ['-- set-init', self.s()])
+        self.transition(Proc.INIT)
 
     def set_running(self):
-        debug(0, ['-- set-running', self.s()])
-        self.state = Proc.RUNNING
+        if debugging(0): debug(0, ['-- set-running', self.s()])
+        self.transition(Proc.RUNNING)
 
     def set_waiting(self):
-        debug(0, ['-- set-waiting', self.s()])
+        if debugging(0): debug(0, ['-- set-waiting', self.s()])
         if self.state == Proc.WAITING:
             raise StandardError('oh no')
-        self.state = Proc.WAITING
+        self.transition(Proc.WAITING)
 
     def set_interrupted(self):
-        debug(0, ['-- set-interrupted', self.s()])
-        self.state = Proc.INTERRUPTED
+        if debugging(0): debug(0, ['-- set-interrupted', self.s()])
+        self.transition(Proc.INTERRUPTED)
 
     def set_done(self):
-        debug(0, ['-- set-done', self.s()])
-        self.state = Proc.DONE
+        if debugging(0): debug(0, ['-- set-done', self.s()])
+        self.transition(Proc.DONE)
 
     def set_terminated(self):
-        debug(0, ['-- set-terminated', self.s()])
-        self.state = Proc.TERMINATED
+        if debugging(0): debug(0, ['-- set-terminated', self.s()])
+        self.transition(Proc.TERMINATED)
+
+    # All state changes go through here, so that the machine can keep
+    # its run queue and its count of waiting procs up to date without
+    # having to scan every proc on every tick.
+    def transition(self, state):
+        if self.state == Proc.WAITING: self.machine.waiting_count -= 1
+        if state == Proc.WAITING: self.machine.waiting_count += 1
 
+        self.state = state
+        if self.is_running(): self.machine.schedule(self)
 
     # Important: a channel will set a successful write to "running". but
     # if that write is connected to a closed channel, it needs to preserve
     # the INTERRUPTED state. So on a successful read or write, we only set
     # the state back to RUNNING if we can verify it's still WAITING.
+    #
+    # A proc can also be woken with an interrupt queued while it was
+    # still waiting (see Receiver.interrupt), in which case it goes on
+    # to unwind.
     def try_set_running(self):
-        if self.state == Proc.WAITING:
-            debug(0, ['try_set_running: set to running', self.s()])
+        if self.state == Proc.WAITING and self.interrupts:
+            if debugging(0): debug(0, ['try_set_running: interrupts pending', self.s()])
+            self.set_interrupted()
+        elif self.state == Proc.WAITING:
+            if debugging(0): debug(0, ['try_set_running: set to running', self.s()])
             self.set_running()
         else:
-            debug(0, ['try_set_running: not waiting', self.s()])
+            if debugging(0): debug(0, ['try_set_running: not waiting', self.s()])
 
     def state_name(self):
         if self.state == Proc.INIT: return 'init'
@@ -70,15 +100,21 @@ class Proc(TableEntry):
         assert False
 
     def is_running(self):
-        return self.state in [Proc.INIT, Proc.RUNNING, Proc.INTERRUPTED]
+        return (self.state == Proc.INIT or
+                self.state == Proc.RUNNING or
+                self.state == Proc.INTERRUPTED)
+
+    def is_finished(self):
+        return self.state == Proc.DONE or self.state == Proc.TERMINATED
 
     def __init__(self, machine):
         self.age = 0
         self.state = Proc.INIT
+        self.is_scheduled = False
         self.machine = machine
         self.frames = []
         self.interrupts = []
-        self.status = Success()
+        self.status = success
         self.last_cleaned = []
 
     # Push a new frame on to the call stack, with a given environment
@@ -87,29 +123,36 @@ class Proc(TableEntry):
     # a case-by-case basis by the `tail_elim` parameter for things like
     # loading files, where we need to preserve the base environment.
     def frame(self, env, addr, tail_elim=True):
-        debug(0, ['--', str(self.id), labels_by_addr[addr].name])
+        if debugging(0): debug(0, ['--', str(self.id), labels_by_addr[addr].name])
         assert isinstance(addr, int)
 
         # must setup before tail eliminating so the number of registered
         # channels doesn't go to zero from tail elim
         frame = Frame(self, env, addr)
-        frame.setup()
+        frame.setup(self.current_frame() if self.frames else None)
 
         if tail_elim:
-            eliminated = self.tail_eliminate()
+            eliminated = self.tail_eliminate(frame)
 
             # when we eliminate a frame, we need to preserve
             # its stack variables and compensations for the
-            # new frame.
+            # new frame. Calls and blocks already run in an
+            # extension of the eliminated frame's env, which
+            # we keep as it is (see Env.skip_shadowed_parent
+            # for how loops keep the chain from growing).
             for e in eliminated:
-                frame.env = e.env.extend().merge(frame.env)
+                if frame.env.parent is e.env:
+                    e.env.skip_shadowed_parent()
+                else:
+                    frame.env = e.env.extend().merge(frame.env)
+
                 for comp in e.compensations:
                     frame.compensations.append(comp)
 
         self.frames.append(frame)
         return frame
 
-    def tail_eliminate(self):
+    def tail_eliminate(self, frame):
         out = []
 
         # don't tail eliminate the root frame, for Reasons.
@@ -118,10 +161,11 @@ class Proc(TableEntry):
         if len(self.frames) <= 1: return []
 
         while len(self.frames) > 1 and self.current_frame().should_eliminate():
-            debug(0, ['-- tco', self.s()])
+            if debugging(0): debug(0, ['-- tco', self.s()])
+            frame.take_registration(self.current_frame())
             out.append(self.pop())
 
-        debug(0, ['-- post-tco', self.s()])
+        if debugging(0): debug(0, ['-- post-tco', self.s()])
 
         return out
 
@@ -134,9 +178,9 @@ class Proc(TableEntry):
         return top
 
     def step(self):
-        debug(0, ['=== step %s ===' % self.s()])
+        if debugging(0): debug(0, ['=== step %s ===' % self.s()])
 
-        if self.frames:
+        if self.frames and debugging(0):
             env = self.current_frame().env
             debug(0, ['env:', env.s()])
             debug(0, ['in:', env.get_input(0).s() if env.get_input(0) else '_'])
@@ -144,41 +188,55 @@ class Proc(TableEntry):
 
         try:
             while self.frames and self.is_running():
+                frame = self.current_frame()
+                pc = frame.pc
+                jit_driver.jit_merge_point(pc=pc, frame=frame, proc=self)
+
                 # IMPORTANT: only check interrupts when we're waiting!
                 if self.state == Proc.INTERRUPTED and self.check_interrupts(): return
 
                 if self.last_cleaned:
-                    debug(0, ['-- emptying last_cleaned'] +
-                             [f.s() for f in self.last_cleaned])
-
-                self.last_cleaned = []
-                self.set_running()
-                self.current_frame().step()
+                    if debugging(0):
+                        debug(0, ['-- emptying last_cleaned'] +
+                                 [f.s() for f in self.last_cleaned])
+                    self.last_cleaned = []
+
+                if self.state != Proc.RUNNING: self.set_running()
+                frame.step()
+
+                # a jump backwards or a call into a function (which is how
+                # loops are written in magritte) is where a loop can close.
+                if not self.frames: continue
+                frame = self.current_frame()
+                if frame.pc <= pc:
+                    pc = frame.pc
+                    jit_driver.can_enter_jit(pc=pc, frame=frame, proc=self)
         except Crash as e:
             print '-- crash', e.status.s()
-            debug(0, ['-- crashed', self.s()])
+            if debugging(0): debug(0, ['-- crashed', self.s()])
             self.status = e.status
             self.set_terminated()
 
         if not self.frames:
-            debug(0, ['out of frames', self.s()])
+            if debugging(0): debug(0, ['out of frames', self.s()])
             self.set_done()
         else:
-            debug(0, ['still has frames!', self.s()])
+            if debugging(0): debug(0, ['still has frames!', self.s()])
 
 
     def check_interrupts(self):
-        debug(0, ['check_interrupts', self.s()])
+        if debugging(0): debug(0, ['check_interrupts', self.s()])
         if not self.interrupts: return False
 
         interrupt = self.interrupts.pop(0)
-        debug(0, ['-- interrupted', self.s(), interrupt.s()])
+        if debugging(0): debug(0, ['-- interrupted', self.s(), interrupt.s()])
 
         # unwind the stack until the channel goes out of scope
         if isinstance(interrupt, Close):
-            debug(0, ['channel closed', interrupt.s()])
-            debug(0, ['env:', self.current_frame().env.s()])
-            debug(0, ['has channel?', str(self.has_channel(interrupt.is_input, interrupt.channel))])
+            if debugging(0):
+                debug(0, ['channel closed', interrupt.s()])
+                debug(0, ['env:', self.current_frame().env.s()])
+                debug(0, ['has channel?', str(self.has_channel(interrupt.is_input, interrupt.channel))])
 
             while self.frames and self.has_channel(interrupt.is_input, interrupt.channel):
                 debug(0, ['unwind!'])
@@ -189,17 +247,21 @@ class Proc(TableEntry):
                 self.pop()
 
         for frame in self.last_cleaned:
-            debug(0, ['-- compensating', frame.s(), str(len(frame.compensations))])
+            if debugging(0): debug(0, ['-- compensating', frame.s(), str(len(frame.compensations))])
             for (addr, _) in frame.compensations:
-                debug(0, ['-- unwind-comp', frame.s(), labels_by_addr[addr].name])
+                if debugging(0): debug(0, ['-- unwind-comp', frame.s(), labels_by_addr[addr].name])
                 self.frame(frame.env, addr)
 
-        if self.frames:
-            self.set_running()
-        else:
+        # a read's target can close while it waits to unwind from the
+        # read's source, see Receiver.interrupt
+        if not self.frames:
             self.set_done()
+        elif self.interrupts:
+            self.set_interrupted()
+        else:
+            self.set_running()
 
-        debug(0, ['unwound', self.s()] + [f.s() for f in self.last_cleaned])
+        if debugging(0): debug(0, ['unwound', self.s()] + [f.s() for f in self.last_cleaned])
 
         return True
 
@@ -207,10 +269,16 @@ class Proc(TableEntry):
         return self.current_frame().env.has_channel(is_input, channel)
 
     def interrupt(self, interrupt):
-        debug(0, ['interrupt', self.s(), interrupt.s()])
+        if debugging(0): debug(0, ['interrupt', self.s(), interrupt.s()])
         self.interrupts.append(interrupt)
         self.set_interrupted()
 
+    # an interrupt for a proc that has to stay waiting for now. it
+    # unwinds once it's woken, see try_set_running.
+    def queue_interrupt(self, interrupt):
+        if debugging(0): debug(0, ['queue interrupt', self.s(), interrupt.s()])
+        self.interrupts.append(interrupt)
+
     def s(self):
         out = ['<proc', str(self.id), ':', self.state_name()]
         for frame in self.frames:
@@ -11,6 +11,12 @@ class Success(Status):
     def s(self):
         return '<success>'
 
+    def eq(self, other):
+        return isinstance(other, Success)
+
+# a Success carries nothing, so they are all the same one
+success = Success()
+
 class Fail(Status):
     def __init__(self, reason):
         self.reason = reason
@@ -20,3 +26,8 @@ class Fail(Status):
 
     def s(self):
         return '<fail %s>' % self.reason.s()
+
+    def eq(self, other):
+        if self is other: return True
+        if not isinstance(other, Fail): return False
+        return self.reason.eq(other.reason)
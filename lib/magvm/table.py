@@ -24,6 +24,21 @@ class Table(object):
             print 'no index', idx
             raise
 
+# Ids for short-lived entries, i.e. procs and channels. The entries
+# themselves are not kept here - they stay alive only as long as
+# something (the run queue, a wait queue, an env) refers to them, so
+# dead ones are collected as usual. Ids come from a counter and are
+# never reused, so they stay unambiguous in the debug logs.
+class Registry(object):
+    def __init__(self):
+        self.next_id = 0
+
+    def register(self, entry):
+        assert isinstance(entry, TableEntry)
+        entry.id = self.next_id
+        self.next_id += 1
+        return entry
+
 class TableEntry(object):
     id = -1
     name = None
@@ -1,7 +1,9 @@
 from machine import machine
 from base import base_env
-from load import load_file, precompile_and_load_file, prefixed
+from load import load_file, load_precompiled, precompile_all, compiled_path, prefixed, BadBytecode
+from cache import bytecode_cache
 from debug import debugger, debug
+from image import prelude_image
 from rpython.rlib.objectmodel import we_are_translated
 import os
 
@@ -10,15 +12,33 @@ import os
 # The whole program will start at the `entry_point` function.
 
 def run_file(filename):
-    load_file(filename)
+    if filename.endswith('.mag'):
+        load_precompiled(filename, compiled_path(filename))
+    else:
+        load_file(filename)
     machine.spawn_label(base_env, 'main')
     machine.run()
     return 0
 
-def run_prelude():
-    main = precompile_and_load_file(prefixed('/lib/mag/prelude.mag'))
+def run_prelude(fname):
+    prelude_image.discard()
+    main = load_precompiled(fname, compiled_path(fname))
     machine.spawn(base_env, main.addr)
 
+def run(filename):
+    prelude = prefixed('/lib/mag/prelude.mag')
+    needs_prelude = not prelude_image.is_fresh(prelude)
+
+    # compile everything we already know we'll load up front,
+    # in one go rather than a magc round trip per file
+    sources = []
+    if needs_prelude: sources.append(prelude)
+    if filename.endswith('.mag'): sources.append(filename)
+    precompile_all(sources)
+
+    if needs_prelude: run_prelude(prelude)
+    return run_file(filename)
+
 def usage():
     print "TODO: usage"
 
@@ -35,21 +55,33 @@ def entry_point(argv):
         arg = argv.pop(0)
         if arg == '-f':
             filename = argv.pop(0)
+        elif arg == '--cache-dir':
+            bytecode_cache.dir = argv.pop(0)
         elif arg == '-h':
             usage()
         else:
             filename = arg
 
+    bytecode_cache.setup()
+
     if filename is None:
         usage()
         return 1
 
-    run_prelude()
-    return run_file(filename)
+    try:
+        return run(filename)
+    except BadBytecode as e:
+        os.write(2, 'magvm: %s: %s\n' % (filename, e.msg))
+        return 1
 
 def target(*args):
+    prelude_image.build(prefixed('/lib/mag/prelude.mag'))
     return entry_point
 
+def jitpolicy(driver):
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
+
 if __name__ == '__main__':
     import sys
     entry_point(sys.argv)
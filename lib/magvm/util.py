@@ -1,3 +1,5 @@
+import os
+
 def print_list_s(tag, vals):
     print tag,
     for v in vals: print v.s(),
@@ -24,3 +26,29 @@ def map_int(arr):
         out[i] = int(e)
     return out
 
+
+# 32-bit FNV-1a, for checking that files match what we expect
+def fnv1a(s):
+    h = 0x811c9dc5
+    for c in s:
+        h = ((h ^ ord(c)) * 0x01000193) & 0xffffffff
+    return h
+
+# reads the whole file in one go, so that decoding it is done
+# in memory rather than with a read() syscall for every field
+def read_all(fd):
+    size = os.fstat(fd).st_size
+    chunks = []
+    while True:
+        chunk = os.read(fd, max(size, 4096))
+        if not chunk: break
+        chunks.append(chunk)
+
+    return ''.join(chunks)
+
+def read_file(fname):
+    fd = os.open(fname, os.O_RDONLY, 0o777)
+    try:
+        return read_all(fd)
+    finally:
+        os.close(fd)
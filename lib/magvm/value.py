@@ -1,6 +1,6 @@
 from table import TableEntry
 from symbol import sym
-from debug import debug
+from debug import debug, debugging
 from labels import labels_by_addr
 
 from rpython.rlib.rarithmetic import r_uint, intmask
@@ -60,6 +60,14 @@ class Channelable(object):
     def read(self, proc, count, into): raise NotImplementedError
     def write(self, proc, val): return self.write_all(proc, [val])
 
+    # whether a write can leave the proc waiting on this channel
+    def blocks_writer(self): return False
+
+    # a write on behalf of a read that is still going, see
+    # Receiver.receive_all. only needed where blocks_writer().
+    def forward_all(self, receiver, vals): raise NotImplementedError
+
+    # returns True once the channel has closed for good
     def resolve(self): return False
     def add_writer(self, frame): pass
     def add_reader(self, frame): pass
@@ -71,12 +79,18 @@ class Value(TableEntry):
     invokable = None
     channelable = None
 
+    # set while the value is in the machine's set of channels
+    # waiting to be resolved. see Machine.mark_dirty
+    is_dirty = False
+
     def as_number(self, frame):
         frame.fail(tagged('not a number', self))
 
+    # structural equality. values of different types are never
+    # equal, except that ints and strings compare by their text,
+    # since numbers come in from the outside world as strings.
     def eq(self, other):
-        # TODO
-        return self.s() == other.s()
+        return self is other
 
     def s(self):
         raise NotImplementedError
@@ -89,9 +103,8 @@ class String(Value):
     class Invoke(Invokable):
         def invoke(self, frame, args):
             invokee = None
-            symbol = sym(self.value)
             try:
-                invokee = frame.env.get(symbol)
+                invokee = frame.env.get(self.as_symbol())
             except KeyError:
                 raise frame.fail(tagged('no-such-function', self))
 
@@ -104,17 +117,44 @@ class String(Value):
         assert isinstance(string, str)
         assert string is not None
         self.value = string
+        self.symbol = -1
+        self.parsed = String.NOT_PARSED
+        self.number = 0
         self.invokable = String.Invoke(self)
 
+    # interned on first use. Command names and keys are
+    # compiled to constants, so this is done once per site.
+    def as_symbol(self):
+        if self.symbol < 0: self.symbol = sym(self.value)
+        return self.symbol
+
     def s(self): return self.value
     def typeof(self): return 'string'
 
+    def eq(self, other):
+        if isinstance(other, String): return self.value == other.value
+        if isinstance(other, Int): return self.value == str(other.value)
+        return False
+
+    # the text is parsed on first use, and the result (or the
+    # failure) is kept for the next time
+    NOT_PARSED = 0
+    IS_NUMBER = 1
+    NOT_NUMBER = 2
+
     def as_number(self, frame):
-        try:
-            return int(self.value)
-        except ValueError:
+        if self.parsed == String.NOT_PARSED:
+            try:
+                self.number = int(self.value)
+                self.parsed = String.IS_NUMBER
+            except ValueError:
+                self.parsed = String.NOT_NUMBER
+
+        if self.parsed == String.NOT_NUMBER:
             frame.fail(tagged('not-a-number', self))
 
+        return self.number
+
 class Int(Value):
     def __init__(self, value):
         assert isinstance(value, int)
@@ -126,6 +166,23 @@ class Int(Value):
     def s(self): return str(self.value)
     def typeof(self): return 'int'
 
+    def eq(self, other):
+        if isinstance(other, Int): return self.value == other.value
+        if isinstance(other, String): return str(self.value) == other.value
+        return False
+
+# ints are immutable and compared by value, so the small ones are
+# shared rather than boxed fresh for every result. use mkint() for
+# computed ints.
+SMALL_INT_MIN = -16
+SMALL_INT_MAX = 256
+small_ints = [Int(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX)]
+
+def mkint(value):
+    if SMALL_INT_MIN <= value < SMALL_INT_MAX:
+        return small_ints[value - SMALL_INT_MIN]
+    return Int(value)
+
 class Collection(Value):
     def s(self):
         out = ['<collection']
@@ -142,52 +199,66 @@ class Vector(Value):
     @impl
     class Invoke(Invokable):
         def invoke(self, frame, args):
-            values = self.values
-
-            if len(values) == 0:
+            if self.size() == 0:
                 frame.fail_str('empty invoke')
 
-            invokable = values[0].invokable
-            if not invokable: frame.fail(tagged('bad-invoke', values[0]))
+            head = self.at(0)
+            invokable = head.invokable
+            if not invokable: frame.fail(tagged('bad-invoke', head))
+
+            new_args = self.view(1)
+            for i in range(0, args.size()): new_args.push(args.at(i))
 
-            new_args = Vector(self.values[1:] + args.values)
             invokable.invoke(frame, new_args)
 
     @impl
     class Channel(Channelable):
         def write_all(self, proc, values): self.push_all(values)
+        def write(self, proc, value): self.push(value)
 
-        def add_writer(self, proc):
-            debug(0, ['-- vec add_writer',
-                      str(self.writer_count + 1),
-                      self.s()])
+        def add_writer(self, frame):
+            if debugging(0):
+                debug(0, ['-- vec add_writer',
+                          str(self.writer_count + 1),
+                          self.s()])
             self.writer_count += 1
 
-        def rm_writer(self, proc):
-            debug(0, ['-- vec rm_writer',
-                      str(self.writer_count - 1),
-                      self.s()])
+        def rm_writer(self, frame):
+            if debugging(0):
+                debug(0, ['-- vec rm_writer',
+                          str(self.writer_count - 1),
+                          self.s()])
             self.writer_count -= 1
+
+            # only collections that someone is waiting on need to be
+            # resolved, see .wait_for_close()
+            if self.close_waiters: frame.proc.machine.mark_dirty(self)
             # if self.writer_count == 0:
             #     self.is_closed = True
             #     debug(0, ['-- vec close!'])
 
         def resolve(self):
-            debug(0, ['-- vec resolve', str(self.writer_count), str(len(self.close_waiters or [])), self.s()])
+            if debugging(0): debug(0, ['-- vec resolve', str(self.writer_count), str(len(self.close_waiters or [])), self.s()])
             if self.writer_count > 0: return False
             if self.is_closed: return False
 
             debug(0, ['-- vec close!'])
             self.is_closed = True
 
-            if not self.close_waiters: return False
-            for proc in self.close_waiters:
-                proc.try_set_running()
+            if self.close_waiters:
+                for proc in self.close_waiters:
+                    proc.try_set_running()
 
             return True
 
-    def __init__(self, values):
+    # .values may be shared with other vectors (see .view()), in
+    # which case this vector's elements are the ones from .start
+    # onwards, and the list is copied before it is changed.
+    def __init__(self, values, start=0):
+        assert start >= 0
         self.values = values
+        self.start = start
+        self.shared = False
         self.invokable = Vector.Invoke(self)
         self.channelable = Vector.Channel(self)
         self.close_waiters = None
@@ -195,33 +266,83 @@ class Vector(Value):
         self.writer_count = 0
 
     def wait_for_close(self, proc):
-        debug(0, ['-- is_closed', str(self.is_closed)])
+        if debugging(0): debug(0, ['-- is_closed', str(self.is_closed)])
         if self.is_closed: return
 
         if self.close_waiters: self.close_waiters.append(proc)
         else: self.close_waiters = [proc]
 
         proc.set_waiting()
+        proc.machine.mark_dirty(self)
+
+    def size(self):
+        return len(self.values) - self.start
+
+    def at(self, i):
+        return self.values[self.start + i]
+
+    # the elements as a plain list. this is the backing list itself
+    # whenever possible, so it must not be changed by the caller.
+    def elems(self):
+        if self.start > 0: self.own()
+        return self.values
+
+    # a vector of our elements from `start` on, sharing our list
+    def view(self, start):
+        assert start >= 0
+        self.shared = True
+        out = Vector(self.values, self.start + start)
+        out.shared = True
+        return out
+
+    # removes and returns the first element, without moving the rest
+    def shift(self):
+        out = self.at(0)
+        self.start += 1
+        return out
+
+    # make .values our own list, holding exactly our elements
+    def own(self):
+        start = self.start
+        assert start >= 0
+        if self.shared:
+            self.values = self.values[start:]
+            self.shared = False
+        elif start > 0:
+            del self.values[:start]
+
+        self.start = 0
 
     def push(self, value):
         assert value is not None
+        if self.shared or self.start > 0: self.own()
         self.values.append(value)
 
     def push_all(self, values):
-        for v in values: self.push(v)
+        if self.shared or self.start > 0: self.own()
+        for v in values:
+            assert v is not None
+            self.values.append(v)
 
     def s(self):
         out = ['[']
-        not_first = False
-        for val in self.values:
-            if not_first: out.append(' ')
-            not_first = True
-
-            out.append(val.s())
+        for i in range(0, self.size()):
+            if i > 0: out.append(' ')
+            out.append(self.at(i).s())
 
         out.append(']')
         return ''.join(out)
 
+    def eq(self, other):
+        if self is other: return True
+        if not isinstance(other, Vector): return False
+        if self.size() != other.size(): return False
+
+        for i in range(0, self.size()):
+            if not self.at(i).eq(other.at(i)): return False
+
+        return True
+
     def typeof(self): return 'vector'
 
 class Ref(Value):
@@ -237,6 +358,11 @@ class Ref(Value):
     def s(self):
         return '<ref %s>' % self.value.s()
 
+    def eq(self, other):
+        if self is other: return True
+        if not isinstance(other, Ref): return False
+        return self.value.eq(other.value)
+
     def typeof(self): return 'ref'
 
 class Placeholder(Value):
@@ -252,11 +378,13 @@ class Function(Value):
     @impl
     class Invoke(Invokable):
         def invoke(self, frame, collection):
-            debug(0, ['()', self.label().s()])
-            new_env = frame.env.extend().merge(self.env)
+            if debugging(0): debug(0, ['()', self.label().s()])
+            new_env = frame.env.extend().link(self.env)
             new_frame = frame.proc.frame(new_env, self.addr)
             new_frame.push(collection)
 
+    _immutable_fields_ = ['env']
+
     def __init__(self, env, addr):
         self.env = env
         self.addr = addr
@@ -268,21 +396,30 @@ class Function(Value):
     def s(self):
         return '<function '+self.label().s()+'>'
 
+    def eq(self, other):
+        if self is other: return True
+        if not isinstance(other, Function): return False
+        return self.addr == other.addr and self.env is other.env
+
     def typeof(self): return 'function'
 
 class Intrinsic(Value):
     @impl
     class Invoke(Invokable):
         def invoke(self, frame, collection):
-            self.fn(frame, collection.values)
+            self.fn(frame, collection)
 
     def __init__(self, name, fn):
         self.name = name
         self.fn = fn
+        self.is_direct = False
         self.invokable = Intrinsic.Invoke(self)
 
     def s(self):
         return '@!'+self.name
 
+    def eq(self, other):
+        return isinstance(other, Intrinsic) and self.name == other.name
+
     def typeof(self): return 'intrinsic'
 